@@ -0,0 +1,82 @@
+""" benchmark of the canyon variant extraction against the former BeautifulSoup parsing
+
+Run from the repository root (needs beautifulsoup4, which the bot itself does not use anymore):
+    pip install beautifulsoup4
+    python -m benchmarks.canyon_variants [page.html ...]
+
+Without arguments every saved page in benchmarks/fixtures is measured.
+"""
+
+import glob
+import hashlib
+import os
+import sys
+import timeit
+from utils.canyon_bikes import (
+    VARIANT_CLASS, PURCHASABLE_CLASS, extract_variant_fragment, parse_variant_availability)
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+REPEAT = 5
+
+
+def parse_with_soup(page_html):
+    """
+    The parsing of the bot before the extraction (a full BeautifulSoup tree of the page)
+
+    Returns:
+        dict - variant (XS, S, M, L ...) to availability
+    """
+    soup = BeautifulSoup(page_html, features="html.parser")
+    availability = {}
+    for v in soup.find_all(class_=VARIANT_CLASS):
+        variant = v.getText().strip()
+        availability[variant] = availability.get(variant, False) or PURCHASABLE_CLASS in v["class"]
+    return availability
+
+
+def check_page(page_html):
+    """
+    What the bot does for a fetched page: cut the variant buttons, hash them and parse them
+    """
+    fragment = extract_variant_fragment(page_html)
+    hashlib.sha256(fragment.encode()).hexdigest()
+    return parse_variant_availability(fragment)
+
+
+def best_of(function, page_html):
+    """
+    Returns the fastest of REPEAT runs in milliseconds
+    """
+    timer = timeit.Timer(lambda: function(page_html))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=REPEAT, number=number)) / number * 1000
+
+
+def main(paths):
+    """
+    Measures both parsers on every page and checks that they agree
+    """
+    if BeautifulSoup is None:
+        sys.exit("beautifulsoup4 is needed for the comparison: pip install beautifulsoup4")
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            page_html = f.read()
+        expected = parse_with_soup(page_html)
+        result = check_page(page_html)
+        if result != expected:
+            sys.exit(f"{path}: results differ - soup {expected}, extraction {result}")
+
+        soup_ms = best_of(parse_with_soup, page_html)
+        extract_ms = best_of(check_page, page_html)
+        print(f"{os.path.basename(path)} ({len(page_html) / 1024:.0f} kB, {len(result)} variants): "
+              f"soup {soup_ms:.1f} ms, extraction {extract_ms:.2f} ms "
+              f"({soup_ms / extract_ms:.0f}x faster)")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or sorted(glob.glob(os.path.join(FIXTURE_DIR, "*.html"))))
@@ -0,0 +1,119 @@
+""" benchmark of the cpu one voice stream costs - pcm (encoded by the bot) against opus codec copy
+
+Run from the repository root (needs ffmpeg and libopus, like the bot):
+    python -m benchmarks.voice_cpu [audio file] [number of streams]
+
+Without a file a 60 s test tone is generated with ffmpeg, a file of the audio cache
+(audio/<video id>.opus) gives more realistic numbers. Every source is read through read()
+as fast as possible, the cpu time is divided by the played audio time, so the result is
+the share of one core a stream needs while it plays in real time.
+"""
+
+import ctypes.util
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import discord
+
+DEFAULT_STREAMS = 4
+TONE_SECONDS = 60
+FRAME_SECONDS = 0.02  # discord sends 20 ms frames
+
+
+def _cpu_seconds(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _load_opus():
+    """
+    Loads libopus, the bot needs it to encode pcm (returns False if it is missing)
+    """
+    if not discord.opus.is_loaded():
+        name = ctypes.util.find_library("opus")
+        if name is None:
+            return False
+        discord.opus.load_opus(name)
+    return True
+
+
+def _make_tone(directory):
+    """
+    Generates a test tone stored as opus like the downloads
+    """
+    path = os.path.join(directory, "tone.opus")
+    subprocess.run(
+        ["ffmpeg", "-loglevel", "error", "-f", "lavfi",
+         "-i", f"sine=frequency=440:duration={TONE_SECONDS}", "-ac", "2",
+         "-c:a", "libopus", "-b:a", "128k", path],
+        check=True)
+    return path
+
+
+def measure(create_source, streams, encoder=None):
+    """
+    Reads streams sources of create_source round robin until all of them ended
+
+    Returns:
+        played seconds per stream, cpu seconds of the ffmpeg processes and of this process
+    """
+    children_before, self_before = _cpu_seconds(resource.RUSAGE_CHILDREN), _cpu_seconds(
+        resource.RUSAGE_SELF)
+    sources = [create_source() for _ in range(streams)]
+    frames = 0
+    playing = list(sources)
+    while playing:
+        for source in list(playing):
+            data = source.read()
+            if not data:
+                playing.remove(source)
+                continue
+            if encoder is not None:  # what the voice client does with pcm
+                encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+            frames += 1
+    for source in sources:
+        source.cleanup()  # waits for ffmpeg, so its cpu time is counted
+    return (frames / streams * FRAME_SECONDS,
+            _cpu_seconds(resource.RUSAGE_CHILDREN) - children_before,
+            _cpu_seconds(resource.RUSAGE_SELF) - self_before)
+
+
+def report(name, streams, played, ffmpeg_cpu, bot_cpu):
+    """
+    Prints the cpu per stream as share of one core while the stream plays
+    """
+    per_stream = played * streams / 100  # cpu seconds which are 1% of a core
+    print(f"{name:<28} ffmpeg {ffmpeg_cpu / per_stream:5.2f}%  bot {bot_cpu / per_stream:5.2f}%  "
+          f"total {(ffmpeg_cpu + bot_cpu) / per_stream:5.2f}% of a core per stream "
+          f"({streams} streams, {played:.0f} s each)")
+
+
+def main(path, streams):
+    """
+    Measures both kinds of sources on the same file
+    """
+    encoder = discord.opus.Encoder() if _load_opus() else None
+    if encoder is None:
+        print("libopus not found - the pcm numbers miss the encoding the bot would do")
+
+    start = time.perf_counter()
+    report("FFmpegPCMAudio (+ encode)", streams,
+           *measure(lambda: discord.FFmpegPCMAudio(path), streams, encoder))
+    report("FFmpegOpusAudio codec copy", streams,
+           *measure(lambda: discord.FFmpegOpusAudio(path, codec="opus"), streams))
+    print(f"measured in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    stream_count = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_STREAMS
+    try:
+        if len(sys.argv) > 1:
+            main(sys.argv[1], stream_count)
+        else:
+            with tempfile.TemporaryDirectory() as tmp:
+                main(_make_tone(tmp), stream_count)
+    except (FileNotFoundError, discord.ClientException) as e:
+        sys.exit(f"ffmpeg is needed for the benchmark: {e}")
@@ -1,39 +1,47 @@
 """ discord bot file defining the setup and all commands/tasks of the bot """
 
+from dataclasses import astuple
 from datetime import datetime
+import io
 import os
 import logging
-import shutil
 import sqlite3
 import discord
 from discord.ext import commands, tasks
 from dotenv import load_dotenv
-from utils.canyon_bikes import check_bike
-from utils.exceptions import (
-    APIError, SubredditNotFoundOrEmptyError, DownloadFailedError)
+from utils.audio_cache import load_audio_cache
+from utils.canyon_bikes import check_bikes
+from utils.exceptions import APIError, SubredditNotFoundOrEmptyError
 from utils.fuel_api import Station, get_station_prices_by_address
-from utils.tagesschau import Ressort, parse_news_data_by_ressort, News, get_tagesschau_video_url
+from utils.fuel_history import (
+    FUELS, HISTORY_DAYS, load_history, track_stations, sample_prices, get_price_stats)
+from utils.tagesschau import (
+    Ressort, News, NewsFeed, REFRESH_INTERVAL_MINUTES, VIDEO_REFRESH_TIME, refresh_news,
+    get_latest_news, get_tagesschau_video_url, refresh_tagesschau_video)
 from utils.weather_api import (
     parse_weather_data_by_location_today, parse_weather_data_by_location_tomorrow)
-from utils.reddit import get_post
+from utils.weather_icon_store import (
+    load_icons, get_icon, get_uploaded_url as get_uploaded_icon_url,
+    remember_uploaded_url as remember_uploaded_icon_url)
+from utils.news_subscriptions import (
+    TOPICS, load_subscriptions, subscribe, unsubscribe, collect_news_deliveries)
+from utils.outbox import Priority, enqueue_embeds
+from utils.reddit import (
+    REFRESH_INTERVAL_MINUTES as REDDIT_REFRESH_INTERVAL_MINUTES, get_post,
+    refresh_popular_subreddits)
 from utils.database import (
-    addreminder_db, delete_bike, fetch_reminders,
-    delete_reminder, add_bike, fetch_bikes, mute_bike, unmute_bike)
+    addreminder_db, delete_bike, fetch_reminders, fetch_due_reminders,
+    delete_reminders, add_bike, fetch_bikes, mute_bike, unmute_bike,
+    fetch_bike_pages, save_bike_pages, save_bikes_notified,
+    fetch_news_subscriptions, fetch_delivered_news)
+from utils.bike_scheduler import (
+    schedule_bike_urls, unschedule_bike_url, reschedule_bike_urls, wait_for_due_bike_urls)
+from utils.reminder_scheduler import (
+    load_reminders, schedule_reminder, wait_for_due_reminders)
 from utils.stromberg import get_random_quote
-from utils.y2ubedownloader import download_audio
+from utils.voice_sessions import get_voice_session, stop_voice_session
 
-# env variables
-load_dotenv()
-bot_token = os.environ.get("BOT_TOKEN")
-
-# set up logging
 logger = logging.getLogger("discord")
-formatter = logging.Formatter(
-    '[{asctime}] [{levelname:<8}] {name}: {message}', '%d.%m.%Y %H:%M:%S', style='{')
-handler = logging.FileHandler(
-    filename='discord.log', encoding='utf-8', mode='a')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
 
 # set up bot
 intents = discord.Intents.default()
@@ -41,6 +49,22 @@ intents.message_content = True
 
 bot = commands.Bot(command_prefix='.', intents=intents)
 
+# reminders queued in the outbox are deleted from the db once they are sent
+sending_reminders = set()  # rowids
+reminder_deliveries = set()  # tasks waiting for the outbox
+
+
+@bot.event
+async def setup_hook():
+    """
+    Loads what the commands need once before the bot connects
+    Not done on import: the download workers are spawned processes which import this module again
+    """
+    # keep the weather icons in memory instead of reading them for every forecast
+    load_icons()
+    # index the cached audio files (replaces clearing the whole folder periodically)
+    load_audio_cache()
+
 
 @bot.event
 async def on_ready():
@@ -50,7 +74,10 @@ async def on_ready():
     """
     logger.info("Bot ready as %s - ID: %s", bot.user, bot.user.id)
     loop_check_reminders.start()
-    loop_clear_audio.start()
+    loop_sample_fuel_prices.start()
+    loop_refresh_news.start()
+    loop_refresh_tagesschau_video.start()
+    loop_refresh_reddit.start()
     # loop_check_bikes.start()
 
 
@@ -70,12 +97,26 @@ async def rreddit(ctx, subredditname: str):
         nothing - posts in the channel the command was posted
     """
     try:
-        post = get_post(subredditname)
+        post = await get_post(subredditname, ctx.channel.id)
         await ctx.send(post)
     except SubredditNotFoundOrEmptyError as e:
         logger.error("User: %s - Command: %s - Error: %s",
                      ctx.author, ctx.command, e)
         await ctx.send(f"Subreddit {subredditname} unbekannt!")
+    except APIError as e:
+        logger.error("User: %s - Command: %s - Error: %s",
+                     ctx.author, ctx.command, e)
+        await ctx.send("Etwas ist schiefgelaufen :(")
+
+
+@tasks.loop(minutes=REDDIT_REFRESH_INTERVAL_MINUTES)
+async def loop_refresh_reddit():
+    """
+    Task - refreshes the hot posts of the most requested subreddits before they expire
+    """
+    for error in await refresh_popular_subreddits():
+        logger.error("Task: loop_refresh_reddit - Error: %s",
+                     error)
 
 
 ############
@@ -110,57 +151,131 @@ async def remindme(ctx, topic, date):
                        f"- Datum und Beschreibung müssen in Anführungszeichen sein")
         return
 
-    resp = addreminder_db(topic, parsed_date,
-                          ctx.channel.id, ctx.message.author.id)
+    resp = await addreminder_db(topic, parsed_date,
+                                ctx.channel.id, ctx.message.author.id)
 
     if isinstance(resp, sqlite3.Error):  # sqlite Error
         logger.error("User: %s - Command: %s - Error: %s",
                      ctx.author, ctx.command, resp)
         await ctx.send("Das hat nicht geklappt")
     else:
+        schedule_reminder(int(parsed_date.timestamp()))
         await ctx.message.add_reaction('👍🏻')
 
 
-@tasks.loop(seconds=10.0)
+@tasks.loop()
 async def loop_check_reminders():
     """
-    Task - Checks all reminders if there is something to remind now
-    Runs every 20 seconds
+    Task - Waits for the next due reminder and posts all due reminders
+    Sleeps until the scheduler has a due reminder instead of polling the db,
+    reminders missed while the bot was offline are due right after startup
 
     Returns:
-        nothing - posts in the channel if there is a reminder now
-    """
-    reminders = fetch_reminders()
-
-    now = datetime.now().replace(microsecond=0).replace(second=0)
-
-    for reminder in reminders:
-        topic = reminder[0]
-        date = reminder[1]
-        channel_id = reminder[2]
-        sender = reminder[3]
-
-        time_to_remind = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
-        if time_to_remind == now:
-            channel = bot.get_channel(channel_id)
-            embed_title = "Erinnerung"
-            embed_desc = f"<@{sender}>\n{topic}"
-            embed_color = discord.Color.random()
-            embed = discord.Embed(
-                title=embed_title, description=embed_desc, color=embed_color)
-            # create funny avatar for user
-            embed.set_thumbnail(url=f'https://robohash.org/{sender}')
-            await channel.send(embed=embed)
-            resp = delete_reminder(
-                topic, date, channel_id, sender)
-            if isinstance(resp, sqlite3.Error):  # sqlite Error
-                logger.error("Task: check_reminders - Error: %s",
-                             resp)
+        nothing - posts in the channels which have a reminder now
+    """
+    now = await wait_for_due_reminders()
+    reminders = await fetch_due_reminders(now)
+    if isinstance(reminders, sqlite3.Error):  # sqlite Error
+        logger.error("Task: check_reminders - Error: %s",
+                     reminders)
+        schedule_reminder(now + 60)  # try again in a minute
+        return
+
+    deliveries = []
+    for rowid, topic, due_at, channel_id, sender in reminders:
+        if rowid in sending_reminders:  # still waiting in the outbox
+            continue
+        channel = bot.get_channel(channel_id)
+        if channel is None:
+            logger.error("Task: check_reminders - Error: channel %s not found",
+                         channel_id)
+            deliveries.append((rowid, None))
+            continue
+        embed_title = "Erinnerung"
+        embed_desc = f"<@{sender}>\n{topic}"
+        embed_color = discord.Color.random()
+        embed = discord.Embed(
+            title=embed_title, description=embed_desc, color=embed_color)
+        # create funny avatar for user
+        embed.set_thumbnail(url=f'https://robohash.org/{sender}')
+        if now - due_at >= 60:  # missed (e.g. bot was offline)
+            embed.set_footer(
+                text=f"Fällig seit {datetime.fromtimestamp(due_at):%d.%m. %H:%M}")
+        # reminders of the same channel are merged into one message by the outbox
+        deliveries.append((rowid, enqueue_embeds(channel, [embed], Priority.REMINDER)))
+
+    if deliveries:
+        sending_reminders.update(rowid for rowid, _ in deliveries)
+        task = bot.loop.create_task(delete_sent_reminders(deliveries))
+        reminder_deliveries.add(task)
+        task.add_done_callback(reminder_deliveries.discard)
+
+
+async def delete_sent_reminders(deliveries):
+    """
+    Deletes the reminders once the outbox sent them (or their channel is gone)
+    Reminders which could not be sent stay in the db and are tried again in a minute
+
+    Parameters:
+        deliveries: array of (rowid, future of the outbox or None if the channel is gone)
+    """
+    try:
+        sent = [rowid for rowid, delivery in deliveries if delivery is None or await delivery]
+        if len(sent) < len(deliveries):
+            schedule_reminder(int(datetime.now().timestamp()) + 60)
+
+        resp = await delete_reminders(sent)
+        if isinstance(resp, sqlite3.Error):  # sqlite Error
+            logger.error("Task: check_reminders - Error: %s",
+                         resp)
+    finally:  # the reminders are never skipped for good
+        sending_reminders.difference_update(rowid for rowid, _ in deliveries)
+
+
+@loop_check_reminders.before_loop
+async def load_scheduled_reminders():
+    """
+    Loads the due times of all reminders from the db into the scheduler once before the loop starts
+    """
+    reminders = await fetch_reminders()
+    if isinstance(reminders, sqlite3.Error):
+        logger.error("Task: check_reminders - Error: %s",
+                     reminders)
+        return
+    load_reminders([reminder[1] for reminder in reminders])
 
 
 ###########
 # WEATHER #
 ###########
+async def send_weather_embed(ctx, embed, weather_code):
+    """
+    Sends a weather embed with the icon of the weather code as thumbnail
+    The icon is only uploaded if there is no valid url of an earlier upload
+
+    Parameters:
+        ctx: Context of the Command (User, Channel ...)
+        embed: the weather embed
+        weather_code: weather code of the forecast
+    """
+    uploaded_url = get_uploaded_icon_url(weather_code)
+    if uploaded_url is not None:
+        embed.set_thumbnail(url=uploaded_url)
+        await ctx.send(embed=embed)
+        return
+
+    icon_bytes = get_icon(weather_code)
+    if icon_bytes is None:  # no icon for this code
+        await ctx.send(embed=embed)
+        return
+
+    icon = discord.File(io.BytesIO(icon_bytes), filename=f"{weather_code}.png")
+    embed.set_thumbnail(url=f"attachment://{weather_code}.png")
+    message = await ctx.send(file=icon, embed=embed)
+    if message.embeds and message.embeds[0].thumbnail.url:
+        remember_uploaded_icon_url(weather_code, message.embeds[0].thumbnail.url)
+
+
 @bot.command()
 async def weather(ctx, location):
     """
@@ -175,7 +290,7 @@ async def weather(ctx, location):
     """
 
     # get the weather objects
-    weather_forecast = parse_weather_data_by_location_today(location)
+    weather_forecast = await parse_weather_data_by_location_today(location)
     if isinstance(weather_forecast, APIError):
         logger.error("User: %s - Command: %s - Error: %s",
                      ctx.author, ctx.command, weather_forecast)
@@ -184,14 +299,10 @@ async def weather(ctx, location):
 
     # build the embed
     weather_code = weather_forecast[0].metadata.weather_code
-    icon = discord.File(
-        f"utils/weather_icons/{weather_code}.png", filename=f"{weather_code}.png")
-    embed_title = f"Wetter Vorhersage für {
-    weather_forecast[0].metadata.location}"
+    embed_title = f"Wetter Vorhersage für {weather_forecast[0].metadata.location}"
     embed_color = discord.Color.random()
     embed = discord.Embed(
         title=embed_title, color=embed_color)
-    embed.set_thumbnail(url=f"attachment://{weather_code}.png")
     for forecast in weather_forecast:
         embed.add_field(
             name=forecast.metadata.time,
@@ -200,7 +311,7 @@ async def weather(ctx, location):
                 {forecast.wind} km/h Wind
                 {forecast.humidity}% Feuchtigkeit""")
 
-    await ctx.send(file=icon, embed=embed)
+    await send_weather_embed(ctx, embed, weather_code)
 
 
 @bot.command()
@@ -217,7 +328,7 @@ async def weathertm(ctx, location):
     """
 
     # get the weather objects
-    weather_forecast = parse_weather_data_by_location_tomorrow(location)
+    weather_forecast = await parse_weather_data_by_location_tomorrow(location)
     if isinstance(weather_forecast, APIError):
         logger.error("User: %s - Command: %s - Error: %s",
                      ctx.author, ctx.command, weather_forecast)
@@ -226,13 +337,10 @@ async def weathertm(ctx, location):
 
     # build the embed
     weather_code = weather_forecast.metadata.weather_code
-    icon = discord.File(
-        f"utils/weather_icons/{weather_code}.png", filename=f"{weather_code}.png")
     embed_title = f"Wetter Vorhersage für {weather_forecast.metadata.location}"
     embed_color = discord.Color.random()
     embed = discord.Embed(
         title=embed_title, color=embed_color)
-    embed.set_thumbnail(url=f"attachment://{weather_code}.png")
     embed.add_field(
         name=weather_forecast.metadata.time,
         value=f"""
@@ -242,7 +350,7 @@ async def weathertm(ctx, location):
             {weather_forecast.sunrise_time} Sonnenaufgang
             {weather_forecast.sunset_time} Sonnenuntergang""")
 
-    await ctx.send(file=icon, embed=embed)
+    await send_weather_embed(ctx, embed, weather_code)
 
 
 #################
@@ -263,14 +371,16 @@ async def addbike(ctx, name, variant, url):
         nothing - posts in the channel the command was posted (success or error)
     """
 
-    resp = add_bike(name, variant, url,
-                    ctx.channel.id, ctx.message.author.id)
+    resp = await add_bike(name, variant, url,
+                          ctx.channel.id, ctx.message.author.id)
 
     if isinstance(resp, sqlite3.Error):  # sqlite Error
         logger.error("User: %s - Command: %s - Error: %s",
                      ctx.author, ctx.command, resp)
         await ctx.send("Das hat nicht geklappt")
     else:
+        # also a page which is watched already, the new watcher is told if it is available
+        schedule_bike_urls([url], right_away=True)
         await ctx.message.add_reaction("👍🏻")
 
 
@@ -287,7 +397,7 @@ async def removebike(ctx, name, variant):
     Returns:
         nothing - posts in the channel the command was posted (success or error)
     """
-    resp = delete_bike(
+    resp = await delete_bike(
         name, variant, ctx.channel.id, ctx.message.author.id)
     if isinstance(resp, sqlite3.Error):  # sqlite Error
         logger.error("User: %s - Command: %s - Error: %s",
@@ -310,7 +420,7 @@ async def mutebike(ctx, name, variant):
     Returns:
         nothing - posts in the channel the command was posted (success or error)
     """
-    resp = mute_bike(name, variant, ctx.channel.id, ctx.message.author.id)
+    resp = await mute_bike(name, variant, ctx.channel.id, ctx.message.author.id)
     if isinstance(resp, sqlite3.Error):
         logger.error("User: %s - Command: %s - Error: %s",
                      ctx.author, ctx.command, resp)
@@ -332,43 +442,101 @@ async def unmutebike(ctx, name, variant):
     Returns:
         nothing - posts in the channel the command was posted (success or error)
     """
-    resp = unmute_bike(name, variant, ctx.channel.id, ctx.message.author.id)
+    resp = await unmute_bike(name, variant, ctx.channel.id, ctx.message.author.id)
     if isinstance(resp, sqlite3.Error):
         logger.error("User: %s - Command: %s - Error: %s",
                      ctx.author, ctx.command, resp)
         await ctx.send("Bike konnte nicht gefunden werden.")
     else:
+        # the shop page may have been dropped from the scheduler while it was muted
+        bikes = await fetch_bikes()
+        if not isinstance(bikes, sqlite3.Error):
+            schedule_bike_urls({bike[2] for bike in bikes})
         await ctx.message.add_reaction("👍🏻")
 
 
-@tasks.loop(minutes=30)
+def send_bike_available(bike):
+    """
+    Tells the user who watches the bike that it is available now (queued in the outbox)
+
+    Parameters:
+        bike: the available bike
+    """
+    channel = bot.get_channel(bike.channel_id)
+    if channel is None:
+        logger.error("Task: loop_check_bikes - Error: channel %s not found",
+                     bike.channel_id)
+        return
+    embed_title = "Bike verfügbar!"
+    embed_desc = f"""
+                Hey <@{bike.sender}>
+                das Bike {bike.name} in {bike.variant} ist jetzt verfügbar!\n{bike.url}"""
+    embed_color = discord.Color.random()
+    embed = discord.Embed(
+        title=embed_title, description=embed_desc, color=embed_color)
+    enqueue_embeds(channel, [embed], Priority.BIKE)
+
+
+@tasks.loop()
 async def loop_check_bikes():
     """
-    Task - Checks all bikes and send a message if a bike is available
-    Runs every 30 minutes
+    Task - Checks the due bikes and send a message if a bike became available
+    Every shop page has its own next check time which backs off while the page does not change
 
     Returns:
         nothing - posts in the channel if there is a available bike
     """
-    bikes = fetch_bikes()
+    urls = await wait_for_due_bike_urls()
+    bikes = await fetch_bikes(urls)
+    if isinstance(bikes, sqlite3.Error):
+        logger.error("Task: loop_check_bikes - Error: %s",
+                     bikes)
+        reschedule_bike_urls(urls, changed_urls=set())
+        return
+    pages = await fetch_bike_pages(urls)
+    if isinstance(pages, sqlite3.Error):
+        logger.error("Task: loop_check_bikes - Error: %s",
+                     pages)
+        reschedule_bike_urls(urls, changed_urls=set())
+        return
+
+    # pages nobody watches anymore (removed or muted) are dropped
+    for url in set(urls) - {bike[2] for bike in bikes}:
+        unschedule_bike_url(url)
+
+    available_bikes, notified_bikes, changed_pages, errors = await check_bikes(bikes, pages)
+    for e in errors:
+        logger.error("Task: loop_check_bikes - Error: %s",
+                     e)
+
+    for bike in available_bikes:
+        send_bike_available(bike)
+    resp = await save_bikes_notified(notified_bikes)
+    if isinstance(resp, sqlite3.Error):
+        logger.error("Task: loop_check_bikes - Error: %s",
+                     resp)
+
+    old_hashes = {page[0]: page[3] for page in pages}
+    reschedule_bike_urls(urls, changed_urls={
+        page.url for page in changed_pages if page.content_hash != old_hashes.get(page.url)})
+
+    resp = await save_bike_pages([astuple(page) for page in changed_pages])
+    if isinstance(resp, sqlite3.Error):
+        logger.error("Task: loop_check_bikes - Error: %s",
+                     resp)
+
+
+@loop_check_bikes.before_loop
+async def load_scheduled_bikes():
+    """
+    Loads the shop urls of all watched bikes into the scheduler once before the loop starts
+    """
+    bikes = await fetch_bikes()
     if isinstance(bikes, sqlite3.Error):
         logger.error("Task: loop_check_bikes - Error: %s",
                      bikes)
         return
-    for bike in bikes:
-        bike_with_availability = check_bike(
-            name=bike[0], variant=bike[1], url=bike[2])
-
-        if bike_with_availability.available:
-            channel = bot.get_channel(bike[3])
-            embed_title = "Bike verfügbar!"
-            embed_desc = f"""
-                        Hey <@{bike[4]}>
-                        das Bike {bike[0]} in {bike[1]} ist jetzt verfügbar!\n{bike[2]}"""
-            embed_color = discord.Color.random()
-            embed = discord.Embed(
-                title=embed_title, description=embed_desc, color=embed_color)
-            await channel.send(embed=embed)
+    schedule_bike_urls({bike[2] for bike in bikes})
 
 
 #############
@@ -396,6 +564,7 @@ async def stromberg(ctx):
 async def listen(ctx, url):
     """
     User command - play YouTube video in given audio channel
+    Every guild has its own session, if something is playing already the video is queued
 
     Parameters
         ctx: Context of the Command (User, Channel ...)
@@ -410,35 +579,19 @@ async def listen(ctx, url):
         await ctx.send('Du musst in einem Voice Channel sein!')
         return
 
-    # check if bot is already connected to voice channel and switch channels
-    for voice_client in bot.voice_clients:
-        await voice_client.disconnect()
-
     await ctx.message.add_reaction('🎵')
 
-    # download audio
-    try:
-        video_info = await download_audio(url)  # also downloads audio
-    except DownloadFailedError as e:
-        logger.error("Command: listen - Error: %s",
-                     e.message)
-        await ctx.send("Etwas ist schiefgelaufen, ist die URL korrekt?")
-        return
-
-    title = video_info[1]
-    video_id = video_info[0]
-
-    vc = await voice.channel.connect()
-
-    # play audio
-    vc.play(discord.FFmpegPCMAudio(
-        source=f"{os.getcwd()}/audio/{title} [{video_id}].m4a"))
+    # connects (or switches channels) and plays the video or queues it
+    session = get_voice_session(ctx.guild.id)
+    position = await session.add(url, voice.channel, ctx.channel)
+    if position:
+        await ctx.send(f"In der Warteschlange auf Platz {position}")
 
 
 @bot.command()
 async def stop(ctx):
     """
-    User command - stops currently playing audio
+    User command - stops currently playing audio and clears the queue of the guild
 
     Parameters
         ctx: Context of the Command (User, Channel ...)
@@ -447,29 +600,25 @@ async def stop(ctx):
         nothing - stops audio
     """
     await ctx.message.add_reaction('👍🏻')
-    # normally should only be one be bot returns a list (idk)
-    for voice_client in bot.voice_clients:
-        voice_client.stop()
+    stop_voice_session(ctx.guild.id)
 
 
-@tasks.loop(minutes=10)
-async def loop_clear_audio():
+##############
+# TAGESSCHAU #
+##############
+def news_embed(n: News):
     """
-    Task - Clears audio folder to keep things clean and small
-    Runs every 10 minutes
-
-    Returns:
-        nothing - logs if ran
+    Creates the embed of a news (breaking news are red)
     """
-    shutil.rmtree(
-        f"{os.getcwd()}/audio")  # currently playing audio file is not deleted
-    logger.info("Task: loop_clear_audio - INFO: %s",
-                "cleared audio folder")
+    embed_title = n.title
+    embed_color = discord.Color.red() if n.breaking_news else discord.Color.random()
+    embed_desc = n.details_web
+    embed = discord.Embed(
+        title=embed_title, color=embed_color, description=embed_desc)
+    embed.set_thumbnail(url=n.teaser_image_url)
+    return embed
 
 
-##############
-# TAGESSCHAU #
-##############
 @bot.command()
 async def news(ctx, ressort: str):
     """
@@ -482,21 +631,22 @@ async def news(ctx, ressort: str):
     Returns:
         nothing - posts in the channel the command was posted (success or error)
     """
-    current_news: [News] = parse_news_data_by_ressort(Ressort(ressort.lower()))
-    if isinstance(current_news, APIError):
+    feed: NewsFeed = await get_latest_news(Ressort(ressort.lower()))
+    if isinstance(feed, APIError):
         logger.error("User: %s - Command: %s - Error: %s",
-                     ctx.author, ctx.command, current_news)
+                     ctx.author, ctx.command, feed)
         await ctx.send("Etwas ist schiefgelaufen :(")
         return
 
-    for n in current_news:
-        embed_title = n.title
-        embed_color = discord.Color.random()
-        embed_desc = n.details_web
-        embed = discord.Embed(
-            title=embed_title, color=embed_color, description=embed_desc)
-        embed.set_thumbnail(url=n.teaser_image_url)
-        await ctx.send(embed=embed)
+    content = None
+    if feed.stale:
+        content = ("Die News konnten nicht aktualisiert werden, "
+                   f"Stand: {feed.refreshed_at:%H:%M} Uhr")
+
+    current_news: [News] = feed.news[:3]  # we only want the newest news
+    if not current_news and content is None:  # discord rejects an empty message
+        content = "Gerade gibt es keine News in diesem Ressort"
+    await ctx.send(content=content, embeds=[news_embed(n) for n in current_news])
 
     return
 
@@ -517,6 +667,91 @@ async def news_error(ctx, error):
             ' (Sport, Wissen, Inland, Ausland, Investigativ, Wirtschaft, Video)'))
 
 
+@bot.command()
+async def subscribenews(ctx, topic: str):
+    """
+    User command - subscribes the channel to the news of a ressort or to breaking news
+
+    Parameters:
+        ctx: Context of the Command (User, Channel ...)
+        topic: ressort or breaking
+
+    Returns:
+        nothing - posts in the channel the command was posted (success or error)
+    """
+    topic = topic.lower()
+    if topic not in TOPICS:
+        await ctx.send(f"Bitte gib eins davon an: {', '.join(TOPICS)}")
+        return
+
+    resp = await subscribe(ctx.channel.id, topic)
+    if isinstance(resp, sqlite3.Error):  # sqlite Error
+        logger.error("User: %s - Command: %s - Error: %s",
+                     ctx.author, ctx.command, resp)
+        await ctx.send("News konnten nicht abonniert werden :(")
+    else:
+        await ctx.message.add_reaction("👍🏻")
+
+
+@bot.command()
+async def unsubscribenews(ctx, topic: str):
+    """
+    User command - unsubscribes the channel from the news of a ressort or from breaking news
+
+    Parameters:
+        ctx: Context of the Command (User, Channel ...)
+        topic: ressort or breaking
+
+    Returns:
+        nothing - posts in the channel the command was posted (success or error)
+    """
+    resp = await unsubscribe(ctx.channel.id, topic.lower())
+    if isinstance(resp, sqlite3.Error):  # sqlite Error
+        logger.error("User: %s - Command: %s - Error: %s",
+                     ctx.author, ctx.command, resp)
+        await ctx.send("News konnten nicht abbestellt werden :(")
+    else:
+        await ctx.message.add_reaction("👍🏻")
+
+
+@tasks.loop(minutes=REFRESH_INTERVAL_MINUTES)
+async def loop_refresh_news():
+    """
+    Task - refreshes the news of all ressorts in the background, so news are answered from memory
+    Posts news which were not delivered yet in the subscribed channels
+    """
+    for error in await refresh_news():
+        logger.error("Task: loop_refresh_news - Error: %s",
+                     error)
+
+    deliveries, errors = await collect_news_deliveries()
+    for error in errors:
+        logger.error("Task: loop_refresh_news - Error: %s",
+                     error)
+    for channel_id, new_news in deliveries.items():
+        channel = bot.get_channel(channel_id)
+        if channel is None:
+            logger.error("Task: loop_refresh_news - Error: channel %s not found",
+                         channel_id)
+            continue
+        enqueue_embeds(channel, [news_embed(n) for n in new_news], Priority.NEWS)
+
+
+@loop_refresh_news.before_loop
+async def load_news_subscriptions():
+    """
+    Loads the news subscriptions and the delivered news once before the loop starts
+    """
+    subscriptions = await fetch_news_subscriptions()
+    delivered = await fetch_delivered_news()
+    for result in (subscriptions, delivered):
+        if isinstance(result, sqlite3.Error):
+            logger.error("Task: loop_refresh_news - Error: %s",
+                         result)
+            return
+    load_subscriptions(subscriptions, delivered)
+
+
 @bot.command()
 async def tagesschau(ctx):
     """
@@ -528,7 +763,7 @@ async def tagesschau(ctx):
     Returns:
         nothing - posts in the channel the command was posted (success or error)
     """
-    video_url = get_tagesschau_video_url()
+    video_url = await get_tagesschau_video_url()
     if isinstance(video_url, APIError):
         logger.error("User: %s - Command: %s - Error: %s",
                      ctx.author, ctx.command, video_url)
@@ -539,6 +774,17 @@ async def tagesschau(ctx):
     await ctx.send(video_url)
 
 
+@tasks.loop(time=VIDEO_REFRESH_TIME)
+async def loop_refresh_tagesschau_video():
+    """
+    Task - resolves the url of the new tagesschau video right after the broadcast
+    """
+    video_url = await refresh_tagesschau_video()
+    if isinstance(video_url, APIError):
+        logger.error("Task: loop_refresh_tagesschau_video - Error: %s",
+                     video_url)
+
+
 #########
 # FUEL #
 ########
@@ -555,13 +801,19 @@ async def tanken(ctx, address: str):
         nothing - posts in the channel the command was posted (success or error)
     """
 
-    stations: [Station] = get_station_prices_by_address(address)
+    stations: [Station] = await get_station_prices_by_address(address)
     if isinstance(stations, APIError):  # pylint: disable=duplicate-code
         logger.error("User: %s - Command: %s - Error: %s",
                      ctx.author, ctx.command, stations)
         await ctx.send("Etwas ist schiefgelaufen :(")
         return
 
+    stations = stations[:25]  # an embed can carry at most 25 fields
+    tracked = await track_stations(stations)
+    if tracked is not True:
+        logger.error("User: %s - Command: %s - Error: %s",
+                     ctx.author, ctx.command, tracked)
+
     embed_title = f"Preisübersicht für {address}"
     embed_color = discord.Color.random()
     embed = discord.Embed(
@@ -577,7 +829,98 @@ async def tanken(ctx, address: str):
     await ctx.send(embed=embed)
 
 
+@bot.command()
+async def tankverlauf(ctx, address: str, sorte: str = "e5", tage: int = 7):
+    """
+    User command - shows how the fuel prices near the address developed
+
+    Parameters
+        ctx: Context of the Command (User, Channel ...)
+        address: address where the prices should be checked
+        sorte: diesel, e5 or e10
+        tage: number of days which are evaluated
+
+    Returns:
+        nothing - posts in the channel the command was posted (success or error)
+    """
+    sorte = sorte.lower()
+    if sorte not in FUELS or not 1 <= tage <= HISTORY_DAYS:
+        await ctx.send(f"Sorte muss eine von {', '.join(FUELS)} sein, "
+                       f"Tage zwischen 1 und {HISTORY_DAYS}")
+        return
+
+    stations: [Station] = await get_station_prices_by_address(address)
+    if isinstance(stations, APIError):
+        logger.error("User: %s - Command: %s - Error: %s",
+                     ctx.author, ctx.command, stations)
+        await ctx.send("Etwas ist schiefgelaufen :(")
+        return
+
+    # asking for the history also starts sampling the stations
+    stations = stations[:25]
+    tracked = await track_stations(stations)
+    if tracked is not True:
+        logger.error("User: %s - Command: %s - Error: %s",
+                     ctx.author, ctx.command, tracked)
+
+    since = datetime.now().timestamp() - tage * 24 * 60 * 60
+    stats = get_price_stats([station.id for station in stations], sorte, since)
+    if not stats:
+        await ctx.send("Für diese Adresse wurden noch keine Preise aufgezeichnet")
+        return
+
+    embed_title = f"{sorte.upper()} Preisverlauf der letzten {tage} Tage für {address}"
+    embed_color = discord.Color.random()
+    embed = discord.Embed(
+        title=embed_title, color=embed_color)
+
+    for station_stats in stats:
+        embed.add_field(
+            name=station_stats.station,
+            value=f"""
+                {station_stats.min:.3f}€ min
+                {station_stats.avg:.3f}€ ⌀
+                {station_stats.max:.3f}€ max
+                am günstigsten um {station_stats.cheapest_hour} Uhr
+                ({station_stats.samples} Messungen)""")
+    await ctx.send(embed=embed)
+
+
+@tasks.loop(minutes=15)
+async def loop_sample_fuel_prices():
+    """
+    Task - records the prices of all stations users asked for every 15 minutes
+    """
+    for error in await sample_prices():
+        logger.error("Task: loop_sample_fuel_prices - Error: %s",
+                     error)
+
+
+@loop_sample_fuel_prices.before_loop
+async def load_fuel_price_history():
+    """
+    Loads the sampled stations and their price history once before the loop starts
+    """
+    for error in await load_history():
+        logger.error("Task: loop_sample_fuel_prices - Error: %s",
+                     error)
+
+
 #########################################
 # START BOT (LAST LINE IN FILE PLS LOL) #
 ########################################
-bot.run(bot_token, log_handler=handler)
+# guarded - the download worker processes import this file again when they start
+if __name__ == "__main__":
+    # env variables
+    load_dotenv()
+    bot_token = os.environ.get("BOT_TOKEN")
+
+    # set up logging
+    formatter = logging.Formatter(
+        '[{asctime}] [{levelname:<8}] {name}: {message}', '%d.%m.%Y %H:%M:%S', style='{')
+    handler = logging.FileHandler(
+        filename='discord.log', encoding='utf-8', mode='a')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    bot.run(bot_token, log_handler=handler)
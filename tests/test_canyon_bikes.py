@@ -0,0 +1,72 @@
+""" tests of the canyon variant extraction """
+
+import os
+import unittest
+from unittest import mock
+from utils.canyon_bikes import (
+    BikePage, check_bikes, extract_variant_fragment, parse_variant_availability)
+from utils.exceptions import APIError
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "..", "benchmarks", "fixtures",
+                       "canyon_endurace.html")
+
+
+class ParseVariantAvailabilityTest(unittest.TestCase):
+    """
+    The extraction has to find the same variants as the former BeautifulSoup parsing
+    """
+
+    def test_saved_page(self):
+        """ all variants of a saved shop page, also from the cut fragment """
+        with open(FIXTURE, encoding="utf-8") as f:
+            page_html = f.read()
+        expected = {"2XS": False, "XS": False, "S": True, "M": False,
+                    "L": True, "XL": True, "2XL": False}
+        self.assertEqual(parse_variant_availability(page_html), expected)
+        self.assertEqual(parse_variant_availability(extract_variant_fragment(page_html)), expected)
+
+    def test_class_outside_of_tags_is_ignored(self):
+        """ the class name in scripts is no variant """
+        page_html = ('<script>var c = "productConfiguration__selectVariant";</script>'
+                     '<li class="x productConfiguration__selectVariant"><div>XS</div></li>')
+        self.assertEqual(parse_variant_availability(page_html), {"XS": False})
+
+    def test_other_attributes_are_no_class(self):
+        """ data-class= is not the class attribute """
+        page_html = ('<button data-class="productConfiguration__selectVariant" '
+                     'class="other">M</button>')
+        self.assertEqual(parse_variant_availability(page_html), {})
+
+    def test_purchasable_variant(self):
+        """ single quotes, > in attributes, entities and nested tags """
+        page_html = ("<button class='productConfiguration__selectVariant "
+                     "productConfiguration__selectVariant--purchasable' data-x='a>b'>"
+                     "<span> S &amp; M </span></button>")
+        self.assertEqual(parse_variant_availability(page_html), {"S & M": True})
+
+
+class CheckBikesTest(unittest.IsolatedAsyncioTestCase):
+    """
+    A page which fails must not stop the check of the other pages
+    """
+
+    async def test_failing_page_is_an_error(self):
+        """ an unexpected error of one page is returned as error """
+        async def refresh(page):
+            if page.url == "broken":
+                raise UnicodeDecodeError("utf-8", b"\xff", 0, 1, "invalid start byte")
+            return BikePage(url=page.url, availability={"M": True}), True
+
+        bikes = [("Bike", "M", url, 1, 2, False, rowid)
+                 for rowid, url in enumerate(("broken", "fine"))]
+        with mock.patch("utils.canyon_bikes.refresh_bike_page", side_effect=refresh):
+            available, notified, changed, errors = await check_bikes(bikes, [])
+        self.assertEqual([bike.url for bike in available], ["fine"])
+        self.assertEqual(notified, [(True, 1)])
+        self.assertEqual([page.url for page in changed], ["fine"])
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], APIError)
+
+
+if __name__ == "__main__":
+    unittest.main()
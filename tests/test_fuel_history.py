@@ -0,0 +1,76 @@
+""" tests of the fuel price history - the database calls are faked """
+
+import time
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import mock
+from utils import fuel_history
+
+
+def station(station_id):
+    """
+    Returns an open station like fuel_api does
+    """
+    return SimpleNamespace(id=station_id, brand="Brand", name=station_id, is_open=True,
+                           diesel=1.659, e5=1.779, e10=False)
+
+
+class FuelHistoryTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Local hours of the samples and which stations are sampled
+    """
+
+    def setUp(self):
+        patchers = {name: mock.patch(f"utils.fuel_history.{name}", return_value=True)
+                    for name in ("save_fuel_stations", "save_fuel_prices",
+                                 "delete_fuel_stations", "delete_fuel_prices_before")}
+        mocks = {name: patcher.start() for name, patcher in patchers.items()}
+        for patcher in patchers.values():
+            self.addCleanup(patcher.stop)
+        self.delete_fuel_stations = mocks["delete_fuel_stations"]
+        self.delete_fuel_prices_before = mocks["delete_fuel_prices_before"]
+        for state in (fuel_history._stations,  # pylint: disable=protected-access
+                      fuel_history._asked_at,  # pylint: disable=protected-access
+                      fuel_history._series):  # pylint: disable=protected-access
+            self.addCleanup(state.clear)
+
+    def test_local_hours_around_dst(self):
+        """ the hours match datetime also where the clocks are changed """
+        sampled_at = range(1711846800 - 4 * 3600, 1711846800 + 4 * 3600, 900)  # 31.03.2024
+        expected = [datetime.fromtimestamp(t, fuel_history.TIMEZONE).hour for t in sampled_at]
+        hours = fuel_history._local_hours(sampled_at)  # pylint: disable=protected-access
+        self.assertEqual(hours.tolist(), expected)
+
+    async def test_least_recently_asked_station_makes_room(self):
+        """ a new station replaces the one nobody asked for the longest """
+        with mock.patch.object(fuel_history, "MAX_TRACKED_STATIONS", 2):
+            self.assertTrue(await fuel_history.track_stations([station("a")]))
+            self.assertTrue(await fuel_history.track_stations([station("b")]))
+            fuel_history._asked_at["a"] -= 60  # pylint: disable=protected-access
+            self.assertTrue(await fuel_history.track_stations([station("c")]))
+        self.assertFalse(fuel_history.is_tracked("a"))
+        self.assertTrue(fuel_history.is_tracked("c"))
+        self.delete_fuel_stations.assert_called_once_with(["a"])
+        self.assertEqual(len(fuel_history.get_price_stats(["c"], "e5", 0)), 1)
+
+    async def test_old_samples_and_stations_are_forgotten(self):
+        """ samples and stations older than the history window are dropped """
+        now = int(time.time())
+        await fuel_history.track_stations([station("a"), station("b")])
+        series = fuel_history._series[("a", "e5")]  # pylint: disable=protected-access
+        series.sampled_at[0] = now - fuel_history.HISTORY_SECONDS - 1
+        series.append(now + 1, 1799)
+        fuel_history._asked_at["b"] = 0  # pylint: disable=protected-access
+
+        errors = await fuel_history._forget_old(now)  # pylint: disable=protected-access
+        self.assertEqual(errors, [])
+        self.assertEqual(list(series.price), [1799])
+        self.assertFalse(fuel_history.is_tracked("b"))
+        self.delete_fuel_stations.assert_called_once_with(["b"])
+        self.delete_fuel_prices_before.assert_called_once_with(
+            [("a", "e5", now - fuel_history.HISTORY_SECONDS)])
+
+
+if __name__ == "__main__":
+    unittest.main()
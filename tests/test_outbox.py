@@ -0,0 +1,52 @@
+""" tests of the outbox - fake channels, no discord needed """
+
+import asyncio
+import unittest
+from unittest import mock
+import aiohttp
+import discord
+from utils.outbox import MAX_MESSAGE_CHARACTERS, Priority, enqueue_embeds
+
+
+def fake_channel(channel_id, send):
+    """
+    Returns a channel whose send is the given coroutine function
+    """
+    channel = mock.MagicMock()
+    channel.id = channel_id
+    channel.send = mock.AsyncMock(side_effect=send)
+    return channel
+
+
+class OutboxTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Every delivery resolves and merged messages stay within the limits of discord
+    """
+
+    async def test_network_error(self):
+        """ a send failing with a network error reports the embeds as not sent """
+        async def send(**_):
+            raise aiohttp.ClientOSError(104, "Connection reset by peer")
+
+        channel = fake_channel(1, send)
+        delivery = enqueue_embeds(channel, [discord.Embed(title="a")], Priority.REMINDER)
+        self.assertFalse(await asyncio.wait_for(delivery, 1))
+
+        channel.send.side_effect = None  # the next embeds get a new worker
+        delivery = enqueue_embeds(channel, [discord.Embed(title="b")], Priority.REMINDER)
+        self.assertTrue(await asyncio.wait_for(delivery, 1))
+
+    async def test_long_embeds_are_split(self):
+        """ the embeds of one message have at most MAX_MESSAGE_CHARACTERS characters together """
+        channel = fake_channel(2, None)
+        embeds = [discord.Embed(description="x" * 2500) for _ in range(5)]
+        self.assertTrue(await enqueue_embeds(channel, embeds, Priority.REMINDER))
+        sizes = [len(call.kwargs["embeds"]) for call in channel.send.call_args_list]
+        self.assertEqual(sizes, [2, 2, 1])
+        for call in channel.send.call_args_list:
+            self.assertLessEqual(sum(len(e) for e in call.kwargs["embeds"]),
+                                 MAX_MESSAGE_CHARACTERS)
+
+
+if __name__ == "__main__":
+    unittest.main()
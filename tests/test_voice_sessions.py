@@ -0,0 +1,79 @@
+""" tests of the voice session queue - fake voice clients, no discord and no ffmpeg needed """
+
+import asyncio
+import unittest
+from unittest import mock
+import discord
+from utils.voice_sessions import VoiceSession
+
+
+class QueueTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Tracks must not get lost while the session connects or stops
+    """
+
+    async def asyncSetUp(self):
+        self.voice_client = mock.MagicMock()
+        self.voice_client.is_connected.return_value = True
+        self.voice_channel = mock.MagicMock()
+        self.voice_channel.connect = mock.AsyncMock(return_value=self.voice_client)
+        self.voice_client.channel = self.voice_channel
+        self.resolving = {}  # url -> event releasing its preparation
+        self.sources = {}  # url -> fake source
+
+        async def prepare(track):
+            self.resolving[track.url] = asyncio.Event()
+            await self.resolving[track.url].wait()
+            self.sources[track.url] = mock.MagicMock()
+            return self.sources[track.url], None
+
+        for patcher in (mock.patch.object(VoiceSession, "_prepare", side_effect=prepare),
+                        mock.patch("utils.voice_sessions.start_download")):  # no prefetch
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.session = VoiceSession(1)
+
+    async def test_track_after_stop_plays(self):
+        """ listen A, stop while A resolves, listen B - B plays and A is thrown away """
+        channel = mock.AsyncMock()
+        self.assertEqual(await self.session.add("a", self.voice_channel, channel), 0)
+        await asyncio.sleep(0)
+        self.session.stop()
+        await self.session.add("b", self.voice_channel, channel)
+
+        self.resolving["a"].set()
+        await asyncio.sleep(0)
+        self.sources["a"].cleanup.assert_called_once()
+        self.voice_client.play.assert_not_called()
+
+        self.resolving["b"].set()
+        await self.session._preparing  # pylint: disable=protected-access
+        self.voice_client.play.assert_called_once()
+        self.assertIs(self.voice_client.play.call_args.args[0], self.sources["b"])
+        self.assertEqual(self.session.current.url, "b")
+        self.assertFalse(self.session.queue)
+
+    async def test_quick_listens_connect_once(self):
+        """ two listens while the voice client connects - both tracks are queued """
+        connected = asyncio.Event()
+
+        async def connect():
+            if connected.is_set():  # like discord.py while the handshake runs
+                raise discord.ClientException("Already connected to a voice channel.")
+            connected.set()
+            await asyncio.sleep(0.01)
+            return self.voice_client
+
+        self.voice_channel.connect.side_effect = connect
+        channel = mock.AsyncMock()
+        positions = await asyncio.gather(self.session.add("a", self.voice_channel, channel),
+                                         self.session.add("b", self.voice_channel, channel))
+        self.assertEqual(positions[0], 0)
+        self.assertGreater(positions[1], 0)
+        self.voice_channel.connect.assert_awaited_once()
+        await asyncio.sleep(0)  # a is being prepared
+        self.assertEqual([track.url for track in self.session.queue], ["b"])
+
+
+if __name__ == "__main__":
+    unittest.main()
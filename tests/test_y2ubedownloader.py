@@ -0,0 +1,96 @@
+""" tests of streaming audio - a local http server stands in for the stream """
+
+import asyncio
+import shlex
+import unittest
+from unittest import mock
+from aiohttp import web, ClientSession
+from utils import y2ubedownloader
+from utils.exceptions import DownloadFailedError
+from utils.voice_sessions import Track, VoiceSession
+from utils.y2ubedownloader import DownloadJob, resolve_stream
+
+AUDIO = b"OggS" + bytes(4096)
+
+
+def tearDownModule():  # pylint: disable=invalid-name
+    """ stops the stream workers, so the test run can end """
+    if y2ubedownloader._stream_executor is not None:  # pylint: disable=protected-access
+        y2ubedownloader._stream_executor.shutdown()  # pylint: disable=protected-access
+
+
+def ffmpeg_headers(options):
+    """
+    Returns the headers ffmpeg sends, parsed back from its input options
+    """
+    args = shlex.split(options)
+    lines = args[args.index("-headers") + 1].split("\r\n")
+    return dict(line.split(": ", 1) for line in lines if line)
+
+
+class StreamTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Resolves streams served by a local http server (no youtube and no ffmpeg needed)
+    """
+
+    async def asyncSetUp(self):
+        self.requests = []
+
+        async def track(request):
+            self.requests.append(dict(request.headers))
+            return web.Response(body=AUDIO, content_type="audio/ogg")
+
+        app = web.Application()
+        app.router.add_get("/track.opus", track)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.url = f"http://127.0.0.1:{port}/track.opus"
+        self.missing_url = f"http://127.0.0.1:{port}/missing.opus"
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+
+    async def test_resolve_stream(self):
+        """ a direct audio url is streamed from where it is served """
+        stream = await resolve_stream(self.url)
+        self.assertEqual(stream.url, self.url)
+        self.assertEqual(stream.id, "track")
+        self.assertTrue(self.requests)  # yt_dlp looked at the url itself
+
+    async def test_headers_round_trip(self):
+        """ ffmpeg sends the same headers as yt_dlp when it reads the stream """
+        stream = await resolve_stream(self.url)
+        options = stream.ffmpeg_before_options()
+        self.assertIn(y2ubedownloader.FFMPEG_RECONNECT_OPTIONS, options)
+        headers = ffmpeg_headers(options)
+        self.assertEqual(headers, stream.http_headers)
+
+        self.requests.clear()
+        async with ClientSession() as session:
+            async with session.get(stream.url, headers=headers) as response:
+                self.assertEqual(await response.read(), AUDIO)
+        self.assertEqual(self.requests[0]["User-Agent"], headers["User-Agent"])
+
+    async def test_missing_stream_is_downloaded(self):
+        """ a url which can not be streamed (404) is downloaded before it is played """
+        with self.assertRaises(DownloadFailedError):
+            await resolve_stream(self.missing_url)
+
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(["missing", "Missing", "audio/missing.opus"])
+        job = DownloadJob(id=0, url=self.missing_url, future=future)
+        channel = mock.AsyncMock()
+        with mock.patch("utils.voice_sessions.start_download", return_value=job) as download, \
+                mock.patch("utils.voice_sessions.audio_file_source", side_effect=lambda p: p):
+            source, video_id = await VoiceSession(1)._prepare(  # pylint: disable=protected-access
+                Track(url=self.missing_url, channel=channel))
+        download.assert_called_once_with(self.missing_url)
+        self.assertEqual((source, video_id), ("audio/missing.opus", "missing"))
+        channel.send.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
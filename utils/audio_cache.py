@@ -0,0 +1,141 @@
+""" content addressed cache of downloaded audio files (audio/<video id>.<ext>) """
+
+import os
+import re
+import urllib.parse
+from collections import Counter, OrderedDict
+import discord
+
+AUDIO_DIR = f"{os.getcwd()}/audio"
+# least recently played files are deleted once the cache is larger than this
+MAX_CACHE_BYTES = 2 * 1024 ** 3
+
+_VIDEO_ID = re.compile(r"[A-Za-z0-9_-]{11}")
+_CACHE_FILE = re.compile(r"([A-Za-z0-9_-]{11})\.(\w+)")
+
+_index = OrderedDict()  # video id -> (path, size), least recently played first
+_pins = Counter()  # video id -> number of players playing / downloads writing the file
+
+
+def video_id_from_url(url):
+    """
+    Returns the youtube video id of the url without asking youtube
+    (youtube.com/watch?v=, youtu.be/, /shorts/, /embed/, /live/)
+
+    Returns:
+        video id or None if the url is no known youtube url
+    """
+    parsed = urllib.parse.urlparse(url.strip())
+    host = (parsed.hostname or "").removeprefix("www.").removeprefix("m.")
+    if host == "youtu.be":
+        candidate = parsed.path.strip("/").split("/")[0]
+    elif host in ("youtube.com", "music.youtube.com", "youtube-nocookie.com"):
+        parts = parsed.path.strip("/").split("/")
+        if parts[0] == "watch":
+            candidate = urllib.parse.parse_qs(parsed.query).get("v", [""])[0]
+        elif parts[0] in ("shorts", "embed", "live", "v") and len(parts) > 1:
+            candidate = parts[1]
+        else:
+            return None
+    else:
+        return None
+    return candidate if _VIDEO_ID.fullmatch(candidate) else None
+
+
+def load_audio_cache():
+    """
+    Indexes the cached files (called once on startup of the bot), least recently played first
+    Leftovers which are not part of the cache (partial downloads, thumbnails ...) are deleted,
+    except the files of running downloads (yt_dlp names its temporary files <video id>.*)
+    """
+    os.makedirs(AUDIO_DIR, exist_ok=True)
+    files = []
+    for entry in os.scandir(AUDIO_DIR):
+        match = _CACHE_FILE.fullmatch(entry.name)
+        if entry.is_file() and match:
+            stat = entry.stat()
+            files.append((stat.st_mtime, match.group(1), entry.path, stat.st_size))
+        elif entry.is_file() and entry.name.split(".")[0] not in _pins:
+            os.remove(entry.path)
+    for _, video_id, path, size in sorted(files):
+        _index[video_id] = (path, size)
+    _evict()
+
+
+def get_cached_audio(video_id):
+    """
+    Returns the path of the cached audio and marks it as recently played
+
+    Returns:
+        path or None if the video is not cached
+    """
+    cached = _index.get(video_id)
+    if cached is None:
+        return None
+    if not os.path.exists(cached[0]):  # deleted by hand
+        del _index[video_id]
+        return None
+    _index.move_to_end(video_id)
+    os.utime(cached[0])  # the order survives restarts
+    return cached[0]
+
+
+def audio_file_source(path):
+    """
+    Returns a source playing the cached file
+    Opus files (everything downloaded now) are sent as they are without re-encoding (codec copy),
+    files of other formats are encoded to opus by ffmpeg
+
+    Parameters:
+        path: path of the audio file
+
+    Returns:
+        discord.FFmpegOpusAudio
+    """
+    codec = "opus" if path.endswith(".opus") else None
+    return discord.FFmpegOpusAudio(source=path, codec=codec)
+
+
+def add_to_cache(video_id, path):
+    """
+    Adds a downloaded file to the cache and deletes the least recently played files
+    if the cache is over its budget
+
+    Parameters:
+        video_id: youtube video id
+        path: path of the file in AUDIO_DIR
+    """
+    _index[video_id] = (path, os.path.getsize(path))
+    _index.move_to_end(video_id)
+    _evict()
+
+
+def pin(video_id):
+    """
+    Protects the file from eviction while it is played or downloaded
+    """
+    _pins[video_id] += 1
+
+
+def unpin(video_id):
+    """
+    Releases the protection of pin once the file is not played anymore
+    """
+    _pins[video_id] -= 1
+    if _pins[video_id] <= 0:
+        del _pins[video_id]
+
+
+def _evict():
+    size = sum(cached[1] for cached in _index.values())
+    for video_id in list(_index):
+        if size <= MAX_CACHE_BYTES:
+            return
+        if video_id in _pins:
+            continue
+        path, file_size = _index.pop(video_id)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        size -= file_size
@@ -0,0 +1,123 @@
+""" in-memory scheduler deciding when each watched shop page is checked next """
+
+import asyncio
+import heapq
+import time
+from utils.helper import wait_for_event
+
+# pages which changed are checked again after MIN_INTERVAL_SECONDS,
+# every check without a change doubles the interval up to MAX_INTERVAL_SECONDS
+MIN_INTERVAL_SECONDS = 5 * 60
+MAX_INTERVAL_SECONDS = 6 * 60 * 60
+# global budget for requests to the shop, shared by all watched pages
+REQUESTS_PER_MINUTE = 30
+# upper bound for one sleep so jumps of the wall clock (e.g. after suspend) are noticed
+MAX_SLEEP_SECONDS = 60
+
+# min-heap of (next check, url) - entries whose time does not match _next_check are stale
+_heap = []
+_next_check = {}  # url -> next check (epoch seconds), missing while the page is checked
+_interval = {}  # url -> current interval in seconds
+_tokens = REQUESTS_PER_MINUTE  # pylint: disable=invalid-name
+_last_refill = time.monotonic()
+_changed = asyncio.Event()
+
+
+def _push(url, next_check):
+    _next_check[url] = next_check
+    heapq.heappush(_heap, (next_check, url))
+    _changed.set()
+
+
+def schedule_bike_urls(urls, right_away=False):
+    """
+    Adds shop pages to the scheduler, new pages are checked right away
+    Pages which are already scheduled keep their next check
+
+    Parameters:
+        urls: shop urls of the watched bikes
+        right_away: also check the pages which are already scheduled right away
+            (their interval is kept)
+    """
+    now = time.time()
+    for url in urls:
+        if url not in _next_check or (right_away and _next_check[url] > now):
+            _interval.setdefault(url, MIN_INTERVAL_SECONDS)
+            _push(url, now)
+
+
+def unschedule_bike_url(url):
+    """
+    Removes a shop page nobody is watching anymore from the scheduler
+
+    Parameters:
+        url: shop url of the bike
+    """
+    _next_check.pop(url, None)
+    _interval.pop(url, None)
+
+
+def reschedule_bike_urls(urls, changed_urls):
+    """
+    Schedules the next check of pages after they were checked
+    Changed pages are checked again soon, unchanged (or failed) pages back off exponentially
+
+    Parameters:
+        urls: shop urls which were checked
+        changed_urls: shop urls whose content changed
+    """
+    now = time.time()
+    for url in urls:
+        if url not in _interval:  # unscheduled while it was checked
+            continue
+        if url in changed_urls:
+            _interval[url] = MIN_INTERVAL_SECONDS
+        else:
+            _interval[url] = min(_interval[url] * 2, MAX_INTERVAL_SECONDS)
+        # scheduled again while it was checked (e.g. by addbike) - the earlier check stays
+        _push(url, min(now + _interval[url], _next_check.get(url, float("inf"))))
+
+
+def _refill_tokens():
+    global _tokens, _last_refill  # pylint: disable=global-statement
+    now = time.monotonic()
+    _tokens = min(REQUESTS_PER_MINUTE,
+                  _tokens + (now - _last_refill) * REQUESTS_PER_MINUTE / 60)
+    _last_refill = now
+
+
+async def wait_for_due_bike_urls():
+    """
+    Sleeps until at least one page is due and the request budget allows to check it
+
+    Returns:
+        array of shop urls which should be checked now
+        (removed from the scheduler until they are rescheduled)
+    """
+    global _tokens  # pylint: disable=global-statement
+    while True:
+        now = time.time()
+        _refill_tokens()
+        # drop stale entries
+        while _heap and _next_check.get(_heap[0][1]) != _heap[0][0]:
+            heapq.heappop(_heap)
+
+        urls = []
+        while _heap and _heap[0][0] <= now and _tokens >= 1:
+            next_check, url = heapq.heappop(_heap)
+            if _next_check.get(url) != next_check:  # stale
+                continue
+            del _next_check[url]
+            _tokens -= 1
+            urls.append(url)
+        if urls:
+            return urls
+
+        # sleep until the next page is due (or a token is free) or a new page is scheduled
+        timeout = None
+        if _heap:
+            timeout = max(_heap[0][0] - now, 0)
+            if _tokens < 1:
+                timeout = max(timeout, (1 - _tokens) * 60 / REQUESTS_PER_MINUTE)
+            timeout = min(timeout, MAX_SLEEP_SECONDS)
+        await wait_for_event(_changed, timeout)
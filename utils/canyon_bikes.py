@@ -1,9 +1,24 @@
 """ Canyon Bike helper functions to check availability of chosen bikes  """
 
-from dataclasses import dataclass
+import asyncio
+import functools
+import hashlib
+import html
+import re
+from dataclasses import dataclass, field
 from typing_extensions import Literal
-from bs4 import BeautifulSoup
-import requests
+import aiohttp
+from utils.exceptions import APIError
+from utils.helper import get_session
+
+VARIANT_CLASS = "productConfiguration__selectVariant"
+PURCHASABLE_CLASS = "productConfiguration__selectVariant--purchasable"
+
+# an opening tag (attribute values may contain ">") and the class attribute inside it
+# (the class attribute follows whitespace, so data-class= is not mistaken for it)
+_OPEN_TAG = re.compile(r"""<([a-zA-Z][\w:-]*)((?:[^>"']|"[^"]*"|'[^']*')*)>""")
+_CLASS_ATTR = re.compile(r"""(?:^|\s)class\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))""", re.I)
+_ANY_TAG = re.compile(r"<[^>]*>")
 
 
 @dataclass
@@ -16,30 +31,220 @@ class Bike():
                      "M", "L", "XL", "2XL", "3XL"] = None
     url: str = None
     available: bool = False
+    channel_id: int = None
+    sender: str = None
+
+
+@dataclass
+class BikePage():
+    """
+    Class containing the last known state of a shop page
+    """
+    url: str = None
+    etag: str = None
+    last_modified: str = None
+    content_hash: str = None
+    availability: dict = field(default_factory=dict)
 
 
-def check_bike(name, variant, url):
+async def refresh_bike_page(page: BikePage):
     """
-    Parses the canyon shop website and returns a bool if the given bike is available
+    Fetches the canyon shop website and parses the availability of all variants
+    Sends the validators of the last fetch, so an unchanged page is not downloaded again (304)
+    and only parses the variants if the hash of the variant buttons changed
 
     Parameters:
-        name: Name of the bike
-        variant: variant of the bike (XS, S, M, L ...)
-        url: shop url of the bike
+        page: last known state of the shop page
+
+    Returns:
+        BikePage - new state of the page
+        bool - True if the state changed and should be saved
+    """
+    headers = {}
+    if page.etag:
+        headers["If-None-Match"] = page.etag
+    if page.last_modified:
+        headers["If-Modified-Since"] = page.last_modified
+    try:
+        async with get_session().get(page.url, headers=headers) as response:
+            if response.status == 304:
+                return page, False
+            if response.status != 200:
+                raise APIError(response.reason, response.status)
+            page_html = await response.text()
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise APIError(f"{page.url} {e!r}", None) from e
+
+    fragment = extract_variant_fragment(page_html)
+    content_hash = hashlib.sha256(fragment.encode()).hexdigest()
+    if content_hash == page.content_hash:
+        availability = page.availability
+    else:
+        availability = parse_variant_availability(fragment)
+
+    new_page = BikePage(url=page.url, etag=etag, last_modified=last_modified,
+                        content_hash=content_hash, availability=availability)
+    return new_page, new_page != page
+
+
+@functools.lru_cache
+def _open_close_pattern(tag):
+    return re.compile(rf"<(/?){re.escape(tag)}\b[^>]*>", re.I)
+
+
+def _element_text(page_html, tag, start):
+    """
+    Returns the text of the element whose opening tag ends at start and the end of the element
+    """
+    depth = 1
+    for match in _open_close_pattern(tag).finditer(page_html, start):
+        if match.group(1):
+            depth -= 1
+            if depth == 0:
+                inner = page_html[start:match.start()]
+                return html.unescape(_ANY_TAG.sub("", inner)).strip(), match.end()
+        elif not match.group(0).endswith("/>"):
+            depth += 1
+    return "", len(page_html)
+
+
+def _variant_tag(page_html, position):
+    """
+    Returns the opening tag whose class attribute contains the hit of the variant class
+    at position, None for hits elsewhere (in scripts, css ...)
 
     Returns:
-       Bike: Dataclass of the bike with availability
-    """
-    # grab current shop website and parse
-    page = requests.get(url, timeout=1000)
-    soup = BeautifulSoup(page.text, features="html.parser")
-
-    # find buttons with the different variants
-    variants = soup.find_all(class_="productConfiguration__selectVariant")
-    for v in variants:
-        if v.getText().strip() == variant:
-            if "productConfiguration__selectVariant--purchasable" in v["class"]:
-                return (Bike(name=name, variant=variant,
-                             url=url, available=True))
-    return (Bike(name=name, variant=variant,
-                 url=url, available=False))
+        start of the tag, regex match of the tag and the classes of the tag or None
+    """
+    tag_start = page_html.rfind("<", 0, position)
+    tag = _OPEN_TAG.match(page_html, tag_start) if tag_start != -1 else None
+    if tag is None or tag.end() <= position:
+        return None
+    class_attr = _CLASS_ATTR.search(tag.group(2))
+    classes = "".join(class_attr.groups(default="")).split() if class_attr else []
+    if VARIANT_CLASS not in classes:
+        return None
+    return tag_start, tag, classes
+
+
+def _variant_elements(page_html):
+    """
+    Finds the variant buttons in a page by scanning for the variant class
+    with str.find instead of building a tree of the whole (large) page
+
+    Yields:
+        start and end of the element, its classes and its text
+    """
+    position = page_html.find(VARIANT_CLASS)
+    while position != -1:
+        variant_tag = _variant_tag(page_html, position)
+        if variant_tag is not None:
+            tag_start, tag, classes = variant_tag
+            text, end = _element_text(page_html, tag.group(1), tag.end())
+            yield tag_start, end, classes, text
+            position = page_html.find(VARIANT_CLASS, end)
+        else:
+            position = page_html.find(VARIANT_CLASS, position + len(VARIANT_CLASS))
+
+
+def extract_variant_fragment(page_html):
+    """
+    Cuts the part of the page containing the variant buttons
+    Only the first and the last variant button are looked at, the buttons in between
+    are left to parse_variant_availability (which only runs if the fragment changed)
+
+    Parameters:
+        page_html: html of the shop page
+
+    Returns:
+        str - html from the first to the end of the last variant button (empty if there is none)
+    """
+    position = page_html.find(VARIANT_CLASS)
+    first_tag = None
+    while position != -1 and first_tag is None:
+        first_tag = _variant_tag(page_html, position)
+        position = page_html.find(VARIANT_CLASS, position + len(VARIANT_CLASS))
+    if first_tag is None:
+        return ""
+    position = page_html.rfind(VARIANT_CLASS)
+    last_tag = _variant_tag(page_html, position)
+    while last_tag is None:  # stops at the first button at the latest
+        position = page_html.rfind(VARIANT_CLASS, 0, position)
+        last_tag = _variant_tag(page_html, position)
+
+    _, end = _element_text(page_html, last_tag[1].group(1), last_tag[1].end())
+    return page_html[first_tag[0]:end]
+
+
+def parse_variant_availability(page_html):
+    """
+    Extracts the availability of all variants from a canyon shop page (or a fragment of it)
+
+    Parameters:
+        page_html: html of the shop page
+
+    Returns:
+        dict - variant (XS, S, M, L ...) to availability
+    """
+    availability = {}
+    for _, _, classes, variant in _variant_elements(page_html):
+        availability[variant] = (
+            availability.get(variant, False) or PURCHASABLE_CLASS in classes)
+    return availability
+
+
+async def check_bikes(bikes, pages):
+    """
+    Checks the availability of all given bikes concurrently
+    Every shop page is only fetched once, even if several users watch it
+
+    Parameters:
+        bikes: array of bikes from the db (name, variant, url, channel_id, sender, notified, rowid)
+        pages: array of the last known page states from the db
+            (url, etag, last_modified, content_hash, availability)
+
+    Returns:
+        array - Bike dataclasses of the available bikes whose watchers were not told yet
+        array - (notified, rowid) of the watchers whose notified state changed
+        array - BikePages whose state changed and should be saved
+        array - APIErrors of the pages which could not be checked (they are checked again later)
+    """
+    known_pages = {page[0]: BikePage(*page) for page in pages}
+    urls = list({bike[2] for bike in bikes})
+    results = await asyncio.gather(
+        *[refresh_bike_page(known_pages.get(url, BikePage(url=url))) for url in urls],
+        return_exceptions=True)
+
+    refreshed_pages = {}
+    changed_pages = []
+    errors = []
+    for url, result in zip(urls, results):
+        if isinstance(result, APIError):
+            errors.append(result)
+        elif isinstance(result, Exception):
+            # e.g. a page in an odd charset - only this page fails, the loop goes on
+            errors.append(APIError(f"{url} {result!r}", None))
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            refreshed_pages[url] = result[0]
+            if result[1]:
+                changed_pages.append(result[0])
+
+    # every watcher is told once per time the variant becomes available,
+    # also if the variant was available already when the bike was added
+    available_bikes = []
+    notified_bikes = []
+    for bike in bikes:
+        if bike[2] not in refreshed_pages:
+            continue
+        available = refreshed_pages[bike[2]].availability.get(bike[1], False)
+        if available != bool(bike[5]):
+            notified_bikes.append((available, bike[6]))
+        if available and not bike[5]:
+            available_bikes.append(Bike(
+                name=bike[0], variant=bike[1], url=bike[2], available=True,
+                channel_id=bike[3], sender=bike[4]))
+    return available_bikes, notified_bikes, changed_pages, errors
@@ -1,28 +1,173 @@
 """" helper to connect and work with the sqlite3 database """
 
+import asyncio
+import itertools
+import json
 import os
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from utils.init_db import run_migrations
 
 # env variables
 load_dotenv()
 db_path = os.environ.get("DATABASE")
 
-# set up db connection
-con = sqlite3.connect(db_path)
-cur = con.cursor()
+# all queries run on one dedicated thread, so a slow commit/fsync
+# never blocks the event loop (and the connection never changes threads)
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database")
+
+
+def _connect():
+    """
+    Opens the db connection (runs on the db thread)
+    """
+    connection = sqlite3.connect(db_path)
+    # WAL lets reads run next to a write, NORMAL only fsyncs on checkpoints
+    connection.execute("PRAGMA journal_mode=WAL;")
+    connection.execute("PRAGMA synchronous=NORMAL;")
+    run_migrations(connection)
+    return connection
+
+
+# the connection is opened by the first query, so importing this module
+# (e.g. in a worker process) opens no db and runs no migrations
+_con = None  # pylint: disable=invalid-name
+
+
+def _connection():
+    """
+    Returns the db connection, it is opened on first use (runs on the db thread)
+    """
+    global _con  # pylint: disable=global-statement
+    if _con is None:
+        _con = _connect()
+    return _con
+
+
+# writes are collected for this long and then committed in one transaction
+BATCH_WINDOW_SECONDS = 0.005
+
+_pending_writes = []  # (sql, params, future)
+_flush_task = None  # pylint: disable=invalid-name
+
+
+def _run_write(sql, params):
+    con = _connection()
+    try:
+        con.execute(sql, params)
+        con.commit()
+    except sqlite3.Error:
+        con.rollback()
+        raise
+
+
+def _run_batch(writes):
+    """
+    Commits a batch of writes in one transaction (runs on the db thread)
+    Consecutive writes of the same statement are grouped into one executemany
+
+    Parameters:
+        writes: array of (sql, params)
+
+    Returns:
+        array with None or the sqlite3.Error for every write
+    """
+    con = _connection()
+    try:
+        for sql, group in itertools.groupby(writes, key=lambda write: write[0]):
+            con.executemany(sql, [params for _, params in group])
+        con.commit()
+        return [None] * len(writes)
+    except sqlite3.Error:
+        con.rollback()
+
+    # one write broke the batch - replay them one by one so only that write fails
+    results = []
+    for sql, params in writes:
+        try:
+            _run_write(sql, params)
+            results.append(None)
+        except sqlite3.Error as e:
+            results.append(e)
+    return results
+
+
+def _run_read(sql, params):
+    return _connection().execute(sql, params).fetchall()
+
+
+async def _flush_writes():
+    """
+    Commits all pending writes in batches until the queue is empty
+    """
+    loop = asyncio.get_running_loop()
+    await asyncio.sleep(BATCH_WINDOW_SECONDS)
+    while _pending_writes:
+        writes = _pending_writes.copy()
+        _pending_writes.clear()
+        try:
+            results = await loop.run_in_executor(
+                _executor, _run_batch, [(sql, params) for sql, params, _ in writes])
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            results = [e] * len(writes)
+        for (_, _, future), error in zip(writes, results):
+            if future.done():  # caller is gone
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+
+async def _write(sql, params=()):
+    """
+    Queues a write and waits until the batch containing it is committed
+    """
+    await _write_many(sql, [params])
+
+
+async def _write_many(sql, params_list):
+    """
+    Queues the same statement for every params and waits until all of them are committed
+    """
+    global _flush_task  # pylint: disable=global-statement
+    if not params_list:
+        return
+    loop = asyncio.get_running_loop()
+    futures = []
+    for params in params_list:
+        future = loop.create_future()
+        _pending_writes.append((sql, params, future))
+        futures.append(future)
+    if _flush_task is None or _flush_task.done():
+        _flush_task = loop.create_task(_flush_writes())
+    for result in await asyncio.gather(*futures, return_exceptions=True):
+        if isinstance(result, Exception):
+            raise result
+
+
+async def _read(sql, params=()):
+    """
+    Executes a query on the db thread
+
+    Returns:
+        array of rows
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, _run_read, sql, params)
 
 
 ############
 # REMINDER #
 ###########
-def addreminder_db(topic, date, channel, sender):
+async def addreminder_db(topic, date, channel, sender):
     """
     Inserts a new row into reminder table
 
     Parameters:
         topic: topic of what is to be reminded
-        date: when to remind the user
+        date: when to remind the user (datetime)
         channel: the channel where the command was posted
         sender: the user who send the reminder
 
@@ -31,54 +176,67 @@ def addreminder_db(topic, date, channel, sender):
         on error: sqlite3.Error
     """
     try:
-        cur.execute(
-            f"""
+        await _write(
+            """
         INSERT INTO reminder
-        (topic, date, channel_id, sender)
-        VALUES('{topic}', '{date}', '{channel}', '{sender}');
-        """
+        (topic, due_at, channel_id, sender)
+        VALUES(?, ?, ?, ?);
+        """,
+            (topic, int(date.timestamp()), channel, sender)
         )
-        con.commit()
         return 1
     except sqlite3.Error as e:
         return e  # return back to caller, logging is handled there
 
 
-def fetch_reminders():
+async def fetch_reminders():
     """
     Fetches all reminders from the database
 
     Returns:
-        array of reminders
+        array of reminders (topic, due_at, channel_id, sender)
     """
     try:
-        resp = cur.execute("SELECT * FROM reminder;")
-        reminders = resp.fetchall()
-        return reminders
+        return await _read(
+            "SELECT topic, due_at, channel_id, sender FROM reminder;")
     except sqlite3.Error as e:
         return e  # return back to caller, logging is handled there
 
 
-def delete_reminder(topic, date, channel, sender):
+async def fetch_due_reminders(due_at):
     """
-    Deletes given reminder from database
+    Fetches all reminders which are due at the given time or earlier
+
     Parameters:
-        topic: topic of reminder
-        date: date of reminder
-        channel: channel reminder was posted in
+        due_at: epoch seconds
+
+    Returns:
+        array of reminders (rowid, topic, due_at, channel_id, sender) ordered by due date
+    """
+    try:
+        return await _read(
+            "SELECT rowid, topic, due_at, channel_id, sender FROM reminder "
+            "WHERE due_at <= ? ORDER BY due_at;",
+            (due_at,)
+        )
+    except sqlite3.Error as e:
+        return e  # return back to caller, logging is handled there
+
+
+async def delete_reminders(rowids):
+    """
+    Deletes the given reminders from database in one batch
+    Parameters:
+        rowids: rowids of the reminders
 
     Returns:
         True or sqlite Error
     """
     try:
-        cur.execute(
-            f"DELETE FROM reminder WHERE"
-            f"(topic = '{topic}')"
-            f"AND (date = '{date}')"
-            f"AND (channel_id = {channel})"
-            f"AND (sender = {sender});"
+        await _write_many(
+            "DELETE FROM reminder WHERE rowid = ?;",
+            [(rowid,) for rowid in rowids]
         )
-        con.commit()
         return True
     except sqlite3.Error as e:
         return e  # return back to caller, logging is handled there
@@ -87,7 +245,7 @@ def delete_reminder(topic, date, channel, sender):
 ################
 # Canyon Bikes #
 ################
-def add_bike(name, variant, url, channel, sender):
+async def add_bike(name, variant, url, channel, sender):
     """
     Inserts a new row into bike table
 
@@ -103,36 +261,43 @@ def add_bike(name, variant, url, channel, sender):
         on error: sqlite3.Error
     """
     try:
-        cur.execute(
-            f"""
+        await _write(
+            """
         INSERT INTO bike
         (name, variant, url, channel_id, sender)
-        VALUES('{name}', '{variant}', '{url}', '{channel}', '{sender}');
-        """
+        VALUES(?, ?, ?, ?, ?);
+        """,
+            (name, variant, url, channel, sender)
         )
-        con.commit()
         return 1
     except sqlite3.Error as e:
-        print(e)
         return e  # return back to caller, logging is handled there
 
 
-def fetch_bikes():
+async def fetch_bikes(urls=None):
     """
     Fetches all bikes from the database which are not muted
 
+    Parameters:
+        urls: only fetch the bikes with these shop urls (optional)
+
     Returns:
-        array of bikes
+        array of bikes (name, variant, url, channel_id, sender, notified, rowid)
     """
     try:
-        resp = cur.execute("SELECT * FROM bike where muted=false;")
-        bikes = resp.fetchall()
-        return bikes
+        if urls is None:
+            return await _read(
+                "SELECT name, variant, url, channel_id, sender, notified, rowid FROM bike "
+                "WHERE muted = false;")
+        return await _read(
+            "SELECT name, variant, url, channel_id, sender, notified, rowid FROM bike "
+            f"WHERE muted = false AND url IN ({', '.join('?' * len(urls))});",
+            tuple(urls))
     except sqlite3.Error as e:
         return e  # return back to caller, logging is handled there
 
 
-def delete_bike(name, variant, channel, sender):
+async def delete_bike(name, variant, channel, sender):
     """
     Deletes given bike from database
     Parameters:
@@ -145,20 +310,20 @@ def delete_bike(name, variant, channel, sender):
         True or sqlite Error
     """
     try:
-        cur.execute(
-            f"DELETE FROM bike WHERE"
-            f"(name = '{name}')"
-            f"AND (variant = '{variant}')"
-            f"AND (channel_id = {channel})"
-            f"AND (sender = {sender});"
+        await _write(
+            "DELETE FROM bike WHERE"
+            "(name = ?)"
+            "AND (variant = ?)"
+            "AND (channel_id = ?)"
+            "AND (sender = ?);",
+            (name, variant, channel, sender)
         )
-        con.commit()
         return True
     except sqlite3.Error as e:
         return e  # return back to caller, logging is handled there
 
 
-def mute_bike(name, variant, channel, sender):
+async def mute_bike(name, variant, channel, sender):
     """
     Sets mute column to true for given bike
     Parameters:
@@ -171,20 +336,20 @@ def mute_bike(name, variant, channel, sender):
         True or sqlite Error
     """
     try:
-        cur.execute(
-            f"UPDATE bike set muted=true WHERE"
-            f"(name = '{name}')"
-            f"AND (variant = '{variant}')"
-            f"AND (channel_id = {channel})"
-            f"AND (sender = {sender});"
+        await _write(
+            "UPDATE bike set muted=true WHERE"
+            "(name = ?)"
+            "AND (variant = ?)"
+            "AND (channel_id = ?)"
+            "AND (sender = ?);",
+            (name, variant, channel, sender)
         )
-        con.commit()
         return True
     except sqlite3.Error as e:
         return e  # return back to caller, logging is handled there
 
 
-def unmute_bike(name, variant, channel, sender):
+async def unmute_bike(name, variant, channel, sender):
     """
     Sets mute column to false for given bike
     Parameters:
@@ -197,14 +362,367 @@ def unmute_bike(name, variant, channel, sender):
         True or sqlite Error
     """
     try:
-        cur.execute(
-            f"UPDATE bike set muted=false WHERE"
-            f"(name = '{name}')"
-            f"AND (variant = '{variant}')"
-            f"AND (channel_id = {channel})"
-            f"AND (sender = {sender});"
+        await _write(
+            "UPDATE bike set muted=false WHERE"
+            "(name = ?)"
+            "AND (variant = ?)"
+            "AND (channel_id = ?)"
+            "AND (sender = ?);",
+            (name, variant, channel, sender)
+        )
+        return True
+    except sqlite3.Error as e:
+        return e  # return back to caller, logging is handled there
+
+
+async def save_bikes_notified(bikes):
+    """
+    Updates whether the watchers were told that their variant is available in one batch
+
+    Parameters:
+        bikes: array of (notified, rowid)
+
+    Returns:
+        True or sqlite Error
+    """
+    try:
+        await _write_many(
+            "UPDATE bike SET notified = ? WHERE rowid = ?;",
+            bikes
+        )
+        return True
+    except sqlite3.Error as e:
+        return e  # return back to caller, logging is handled there
+
+
+async def fetch_bike_pages(urls):
+    """
+    Fetches the last known state of the given shop pages
+
+    Parameters:
+        urls: shop urls of the pages
+
+    Returns:
+        array of pages (url, etag, last_modified, content_hash, availability dict)
+    """
+    try:
+        pages = await _read(
+            "SELECT url, etag, last_modified, content_hash, availability FROM bike_page "
+            f"WHERE url IN ({', '.join('?' * len(urls))});",
+            tuple(urls))
+        return [(*page[:4], json.loads(page[4])) for page in pages]
+    except sqlite3.Error as e:
+        return e  # return back to caller, logging is handled there
+
+
+async def save_bike_pages(pages):
+    """
+    Inserts or updates the state of the given shop pages in one batch
+
+    Parameters:
+        pages: array of pages (url, etag, last_modified, content_hash, availability dict)
+
+    Returns:
+        True or sqlite Error
+    """
+    try:
+        await _write_many(
+            """
+        INSERT INTO bike_page
+        (url, etag, last_modified, content_hash, availability)
+        VALUES(?, ?, ?, ?, ?)
+        ON CONFLICT(url) DO UPDATE SET
+        etag = excluded.etag,
+        last_modified = excluded.last_modified,
+        content_hash = excluded.content_hash,
+        availability = excluded.availability;
+        """,
+            [(*page[:4], json.dumps(page[4])) for page in pages]
+        )
+        return True
+    except sqlite3.Error as e:
+        return e  # return back to caller, logging is handled there
+
+
+#############
+# GEOCODING #
+#############
+async def fetch_geocode(query):
+    """
+    Fetches a cached address lookup
+
+    Parameters:
+        query: normalized address
+
+    Returns:
+        (lat, lng, expires_at) - lat/lng are None for failed lookups, expires_at is None
+        for lookups which never expire - or None if the address is not cached
+    """
+    try:
+        rows = await _read(
+            "SELECT lat, lng, expires_at FROM geocode WHERE query = ?;", (query,))
+        return rows[0] if rows else None
+    except sqlite3.Error as e:
+        return e  # return back to caller, logging is handled there
+
+
+async def save_geocode(query, lat, lng, expires_at):
+    """
+    Inserts or updates a cached address lookup
+
+    Parameters:
+        query: normalized address
+        lat: latitude (None for failed lookups)
+        lng: longitude (None for failed lookups)
+        expires_at: epoch seconds or None if it never expires
+
+    Returns:
+        True or sqlite Error
+    """
+    try:
+        await _write(
+            """
+        INSERT INTO geocode
+        (query, lat, lng, expires_at)
+        VALUES(?, ?, ?, ?)
+        ON CONFLICT(query) DO UPDATE SET
+        lat = excluded.lat,
+        lng = excluded.lng,
+        expires_at = excluded.expires_at;
+        """,
+            (query, lat, lng, expires_at)
+        )
+        return True
+    except sqlite3.Error as e:
+        return e  # return back to caller, logging is handled there
+
+
+###############
+# FUEL PRICES #
+###############
+async def fetch_fuel_stations():
+    """
+    Fetches all stations whose prices are sampled
+
+    Returns:
+        array of (id, brand, name, asked_at) or sqlite Error
+    """
+    try:
+        return await _read("SELECT id, brand, name, asked_at FROM fuel_station;")
+    except sqlite3.Error as e:
+        return e  # return back to caller, logging is handled there
+
+
+async def save_fuel_stations(stations):
+    """
+    Adds stations whose prices should be sampled, known stations are updated
+
+    Parameters:
+        stations: array of (id, brand, name, asked_at)
+
+    Returns:
+        True or sqlite Error
+    """
+    try:
+        await _write_many(
+            """
+        INSERT INTO fuel_station
+        (id, brand, name, asked_at)
+        VALUES(?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+        brand = excluded.brand,
+        name = excluded.name,
+        asked_at = excluded.asked_at;
+        """,
+            stations
+        )
+        return True
+    except sqlite3.Error as e:
+        return e  # return back to caller, logging is handled there
+
+
+async def delete_fuel_stations(station_ids):
+    """
+    Stops sampling the stations and deletes their price history
+
+    Parameters:
+        station_ids: array of station ids
+
+    Returns:
+        True or sqlite Error
+    """
+    try:
+        params = [(station_id,) for station_id in station_ids]
+        await _write_many("DELETE FROM fuel_price WHERE station_id = ?;", params)
+        await _write_many("DELETE FROM fuel_station WHERE id = ?;", params)
+        return True
+    except sqlite3.Error as e:
+        return e  # return back to caller, logging is handled there
+
+
+async def fetch_fuel_prices(station_id, since):
+    """
+    Fetches the price history of one station since the given time
+    (ordered like the primary key, so sqlite reads a single range without sorting)
+
+    Parameters:
+        station_id: id of the station
+        since: epoch seconds
+
+    Returns:
+        array of (fuel, sampled_at, price) ordered by fuel and sampled_at or sqlite Error
+    """
+    try:
+        return await _read(
+            """
+        SELECT fuel, sampled_at, price FROM fuel_price
+        WHERE station_id = ? AND sampled_at >= ?
+        ORDER BY fuel, sampled_at;
+        """,
+            (station_id, since))
+    except sqlite3.Error as e:
+        return e  # return back to caller, logging is handled there
+
+
+async def save_fuel_prices(prices):
+    """
+    Appends sampled prices to the history
+
+    Parameters:
+        prices: array of (station_id, fuel, sampled_at, price in tenths of a cent)
+
+    Returns:
+        True or sqlite Error
+    """
+    try:
+        await _write_many(
+            """
+        INSERT OR IGNORE INTO fuel_price
+        (station_id, fuel, sampled_at, price)
+        VALUES(?, ?, ?, ?);
+        """,
+            prices
+        )
+        return True
+    except sqlite3.Error as e:
+        return e  # return back to caller, logging is handled there
+
+
+async def delete_fuel_prices_before(series):
+    """
+    Deletes the samples which left the history window
+
+    Parameters:
+        series: array of (station_id, fuel, epoch seconds of the oldest sample which is kept)
+
+    Returns:
+        True or sqlite Error
+    """
+    try:
+        await _write_many(
+            """
+        DELETE FROM fuel_price
+        WHERE station_id = ? AND fuel = ? AND sampled_at < ?;
+        """,
+            series
+        )
+        return True
+    except sqlite3.Error as e:
+        return e  # return back to caller, logging is handled there
+
+
+########
+# NEWS #
+########
+async def fetch_news_subscriptions():
+    """
+    Fetches all news subscriptions
+
+    Returns:
+        array of (channel_id, topic) or sqlite Error
+    """
+    try:
+        return await _read("SELECT channel_id, topic FROM news_subscription;")
+    except sqlite3.Error as e:
+        return e  # return back to caller, logging is handled there
+
+
+async def add_news_subscription(channel, topic):
+    """
+    Subscribes a channel to a news topic
+
+    Parameters:
+        channel: channel which gets the news
+        topic: ressort or breaking
+
+    Returns:
+        True or sqlite Error
+    """
+    try:
+        await _write(
+            "INSERT OR IGNORE INTO news_subscription (channel_id, topic) VALUES(?, ?);",
+            (channel, topic)
+        )
+        return True
+    except sqlite3.Error as e:
+        return e  # return back to caller, logging is handled there
+
+
+async def delete_news_subscription(channel, topic):
+    """
+    Unsubscribes a channel from a news topic
+
+    Parameters:
+        channel: channel which got the news
+        topic: ressort or breaking
+
+    Returns:
+        True or sqlite Error
+    """
+    try:
+        await _write(
+            "DELETE FROM news_subscription WHERE (channel_id = ?) AND (topic = ?);",
+            (channel, topic)
+        )
+        return True
+    except sqlite3.Error as e:
+        return e  # return back to caller, logging is handled there
+
+
+async def fetch_delivered_news():
+    """
+    Fetches the hashes of the delivered news of every topic
+
+    Returns:
+        array of (topic, news_hashes) or sqlite Error
+    """
+    try:
+        return await _read("SELECT topic, news_hashes FROM news_delivered;")
+    except sqlite3.Error as e:
+        return e  # return back to caller, logging is handled there
+
+
+async def save_delivered_news(delivered):
+    """
+    Inserts or updates the hashes of the delivered news
+
+    Parameters:
+        delivered: array of (topic, news_hashes as bytes)
+
+    Returns:
+        True or sqlite Error
+    """
+    try:
+        await _write_many(
+            """
+        INSERT INTO news_delivered
+        (topic, news_hashes)
+        VALUES(?, ?)
+        ON CONFLICT(topic) DO UPDATE SET
+        news_hashes = excluded.news_hashes;
+        """,
+            delivered
         )
-        con.commit()
         return True
     except sqlite3.Error as e:
         return e  # return back to caller, logging is handled there
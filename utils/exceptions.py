@@ -42,3 +42,18 @@ class DownloadFailedError(Exception):
     def __init__(self, message):
         self.message = message
         super().__init__(self.message)
+
+
+class DownloadQueueFullError(Exception):
+    """
+    Custom Exception when too many downloads are running or waiting
+
+    Attributes:
+        max_downloads: number of downloads which can run or wait at once
+        message: explanation of the error
+    """
+
+    def __init__(self, max_downloads):
+        self.max_downloads = max_downloads
+        self.message = f"{max_downloads} downloads are already running or waiting"
+        super().__init__(self.message)
@@ -1,18 +1,31 @@
 """ helper functions to grab current fuel prices """
 
+import math
 import os
-from dataclasses import dataclass
-import requests
+import time
+from dataclasses import dataclass, replace
 from dotenv import load_dotenv
 from utils.geocoding import resolve_address
 from utils.exceptions import APIError
+from utils.helper import get_json
 
 load_dotenv()
 API_KEY = os.environ.get("FUEL_API_KEY")
 
+SEARCH_RADIUS_KM = 20
+FETCH_RADIUS_KM = 25  # largest radius the api allows
+# stations are cached in tiles of TILE_SIZE_DEG x TILE_SIZE_DEG degrees,
+# prices of a tile are fresh for PRICE_TTL_SECONDS (the api asks for at most one call per 5 min)
+TILE_SIZE_DEG = 0.02
+PRICE_TTL_SECONDS = 5 * 60
+EARTH_RADIUS_KM = 6371
+KM_PER_DEG_LAT = 111.2
+
+_tiles = {}  # (row, col) -> (expires at, array of stations in the tile)
+
 
 @dataclass
-class Station:
+class Station:  # pylint: disable=too-many-instance-attributes
     """
     Class containing station info with prices
     """
@@ -22,39 +35,146 @@ class Station:
     diesel: float
     e5: float
     e10: float
+    id: str = None
+    lat: float = None
+    lng: float = None
+    dist: float = None
+
+
+def _distance_km(lat1, lng1, lat2, lng2):
+    """
+    Haversine distance between two points
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def _tile_of(lat, lng):
+    return math.floor(lat / TILE_SIZE_DEG), math.floor(lng / TILE_SIZE_DEG)
+
+
+def _tiles_around(lat, lng, radius_km):
+    """
+    Yields all tiles in the bounding box of the circle with their bounds
+    """
+    delta_lat = radius_km / KM_PER_DEG_LAT
+    delta_lng = radius_km / (KM_PER_DEG_LAT * max(math.cos(math.radians(lat)), 0.01))
+    min_row, min_col = _tile_of(lat - delta_lat, lng - delta_lng)
+    max_row, max_col = _tile_of(lat + delta_lat, lng + delta_lng)
+    for row in range(min_row, max_row + 1):
+        for col in range(min_col, max_col + 1):
+            yield (row, col), (row * TILE_SIZE_DEG, (row + 1) * TILE_SIZE_DEG,
+                               col * TILE_SIZE_DEG, (col + 1) * TILE_SIZE_DEG)
+
+
+def _tiles_inside(lat, lng, radius_km):
+    """
+    Returns the tiles which lie completely inside the circle
+    """
+    return [tile for tile, (lat_min, lat_max, lng_min, lng_max)
+            in _tiles_around(lat, lng, radius_km)
+            if all(_distance_km(lat, lng, corner_lat, corner_lng) <= radius_km
+                   for corner_lat in (lat_min, lat_max) for corner_lng in (lng_min, lng_max))]
+
+
+def _tiles_touching(lat, lng, radius_km):
+    """
+    Returns the tiles which overlap the circle
+    """
+    return [tile for tile, (lat_min, lat_max, lng_min, lng_max)
+            in _tiles_around(lat, lng, radius_km)
+            if _distance_km(lat, lng, min(max(lat, lat_min), lat_max),
+                            min(max(lng, lng_min), lng_max)) <= radius_km]
 
 
-def get_station_prices_by_address(address: str):
+def _cached_stations(lat, lng, radius_km):
     """
-    Calls the fuel api and and gets prices for address with radius 20km
+    Merges the cached tiles overlapping the circle
+
+    Returns:
+        array of stations or None if a tile is missing or outdated
+    """
+    now = time.time()
+    stations = []
+    for tile in _tiles_touching(lat, lng, radius_km):
+        cached = _tiles.get(tile)
+        if cached is None or cached[0] <= now:
+            return None
+        stations.extend(cached[1])
+    return stations
+
+
+async def _fetch_stations(lat, lng):
+    """
+    Calls the fuel api with the largest radius around the point and caches
+    every tile which lies completely inside of it
 
     Returns:
         station array
     """
-    stations_with_prices = []
-    latlng = resolve_address(address)
     api_base_url = "https://creativecommons.tankerkoenig.de/json/list.php"
     url = (f'{api_base_url}'
-           f'?lat={latlng.lat}'
-           f'&lng={latlng.lng}'
-           f'&rad=20&sort=dist'
+           f'?lat={lat}'
+           f'&lng={lng}'
+           f'&rad={FETCH_RADIUS_KM}&sort=dist'
            f'&type=all'
            f'&apikey={API_KEY}')
     headers = {"accept": "application/json"}  # pylint: disable=duplicate-code
-    response = requests.get(url, headers=headers, timeout=4)
-    response_json = response.json()
-
-    if response.status_code == 200:
-        stations = response_json["stations"]
-        for station in stations:
-            stations_with_prices.append(Station(
-                brand=station["brand"],
-                name=station["name"],
-                is_open=station["isOpen"],
-                diesel=station["diesel"],
-                e5=station["e5"],
-                e10=station["e10"]
-            ))
-        return stations_with_prices
-
-    raise APIError(response_json["message"], response.status_code)
+    status, reason, response_json = await get_json(url, headers=headers)
+
+    if not isinstance(response_json, dict) or not response_json.get("ok", False):
+        message = response_json.get("message") if isinstance(response_json, dict) else None
+        raise APIError(message or reason, status)
+
+    stations = [Station(
+        brand=station["brand"],
+        name=station["name"],
+        is_open=station["isOpen"],
+        diesel=station["diesel"],
+        e5=station["e5"],
+        e10=station["e10"],
+        id=station["id"],
+        lat=station["lat"],
+        lng=station["lng"]
+    ) for station in response_json["stations"]]
+
+    now = time.time()
+    for tile in [tile for tile, (expires, _) in _tiles.items() if expires <= now]:
+        del _tiles[tile]
+    covered = {tile: [] for tile in _tiles_inside(lat, lng, FETCH_RADIUS_KM)}
+    for station in stations:
+        tile = _tile_of(station.lat, station.lng)
+        if tile in covered:
+            covered[tile].append(station)
+    for tile, tile_stations in covered.items():
+        _tiles[tile] = (now + PRICE_TTL_SECONDS, tile_stations)
+
+    return stations
+
+
+async def get_station_prices_by_address(address: str):
+    """
+    Gets prices for all stations within 20km of the address
+    Answers from the cached tiles if nearby addresses were asked for recently,
+    otherwise calls the fuel api once for the area around the address
+
+    Returns:
+        station array sorted by distance
+    """
+    try:
+        latlng = await resolve_address(address)
+        lat, lng = float(latlng.lat), float(latlng.lng)
+        stations = _cached_stations(lat, lng, SEARCH_RADIUS_KM)
+        if stations is None:
+            stations = await _fetch_stations(lat, lng)
+    except APIError as e:
+        return e
+
+    stations_with_prices = []
+    for station in stations:
+        dist = _distance_km(lat, lng, station.lat, station.lng)
+        if dist <= SEARCH_RADIUS_KM:
+            stations_with_prices.append(replace(station, dist=round(dist, 1)))
+    return sorted(stations_with_prices, key=lambda station: station.dist)
@@ -0,0 +1,331 @@
+""" price history of the fuel stations users asked for """
+
+import bisect
+import itertools
+import os
+import sqlite3
+import time
+from array import array
+from dataclasses import dataclass, field
+from datetime import datetime
+from zoneinfo import ZoneInfo
+import numpy as np
+from dotenv import load_dotenv
+from utils.database import (
+    fetch_fuel_stations, save_fuel_stations, delete_fuel_stations,
+    fetch_fuel_prices, save_fuel_prices, delete_fuel_prices_before)
+from utils.exceptions import APIError
+from utils.helper import get_json
+
+load_dotenv()
+API_KEY = os.environ.get("FUEL_API_KEY")
+
+FUELS = ("diesel", "e5", "e10")
+# the prices endpoint answers for at most this many stations per call
+STATIONS_PER_CALL = 10
+# every sampling round costs one call per STATIONS_PER_CALL stations
+MAX_TRACKED_STATIONS = 250
+TIMEZONE = ZoneInfo("Europe/Berlin")
+# samples older than this are dropped, stations nobody asked for as long are not sampled anymore
+HISTORY_DAYS = 30
+HISTORY_SECONDS = HISTORY_DAYS * 24 * 60 * 60
+
+_stations = {}  # station id -> "brand - name"
+_asked_at = {}  # station id -> epoch seconds a user last asked for the station
+_series = {}  # (station id, fuel) -> PriceSeries
+
+
+@dataclass
+class PriceSeries:
+    """
+    Class containing the price samples of one fuel at one station,
+    stored column wise in typed arrays (7 bytes per sample),
+    new samples are appended and samples leaving the history window are dropped from the front
+    """
+    sampled_at: array = field(default_factory=lambda: array("I"))  # epoch seconds
+    hour: array = field(default_factory=lambda: array("B"))  # local hour of the sample
+    price: array = field(default_factory=lambda: array("H"))  # tenths of a cent
+
+    def append(self, sampled_at, price):
+        """
+        Appends a sample, samples older than the last one are ignored
+        """
+        if self.sampled_at and sampled_at <= self.sampled_at[-1]:
+            return
+        self.sampled_at.append(sampled_at)
+        self.hour.append(datetime.fromtimestamp(sampled_at, TIMEZONE).hour)
+        self.price.append(price)
+
+    def drop_before(self, since):
+        """
+        Drops the samples older than since
+
+        Returns:
+            whether samples were dropped
+        """
+        count = bisect.bisect_left(self.sampled_at, since)
+        if count == 0:
+            return False
+        del self.sampled_at[:count]
+        del self.hour[:count]
+        del self.price[:count]
+        return True
+
+
+@dataclass
+class PriceStats:
+    """
+    Class containing the price statistics of one station over a window
+    """
+    station: str
+    samples: int
+    min: float
+    avg: float
+    max: float
+    cheapest_hour: int
+
+
+def _to_tenths_of_cent(price):
+    """
+    Returns the price in tenths of a cent or None if the station has no price for the fuel
+    """
+    if isinstance(price, bool) or not isinstance(price, (int, float)) or price <= 0:
+        return None  # the api sends false for fuels a station does not sell
+    return round(price * 1000)
+
+
+def _append(station_id, fuel, sampled_at, price):
+    series = _series.get((station_id, fuel))
+    if series is None:
+        series = _series[(station_id, fuel)] = PriceSeries()
+    series.append(sampled_at, price)
+
+
+def _local_hours(sampled_at):
+    """
+    Returns the local hour of every sample - the time zone is looked up once per utc hour
+    instead of once per sample (offsets are whole hours and change on full hours)
+    """
+    utc_hours, positions = np.unique(
+        np.asarray(sampled_at, dtype=np.int64) // 3600, return_inverse=True)
+    local_hours = np.array([datetime.fromtimestamp(int(hour) * 3600, TIMEZONE).hour
+                            for hour in utc_hours], dtype=np.uint8)
+    return local_hours[positions]
+
+
+def _untrack(station_ids):
+    for station_id in station_ids:
+        _stations.pop(station_id, None)
+        _asked_at.pop(station_id, None)
+        for fuel in FUELS:
+            _series.pop((station_id, fuel), None)
+
+
+async def load_history():
+    """
+    Loads the tracked stations and their price history of the last HISTORY_DAYS
+    from the database (called once on startup)
+    Every station is read with its own query, so the bot keeps answering in between,
+    samples which left the window are deleted instead of loaded
+
+    Returns:
+        array of sqlite Errors of the queries which failed
+    """
+    stations = await fetch_fuel_stations()
+    if isinstance(stations, sqlite3.Error):
+        return [stations]
+    errors = []
+    since = int(time.time()) - HISTORY_SECONDS
+    for station_id, brand, name, asked_at in stations:
+        _stations[station_id] = f"{brand} - {name}"
+        _asked_at[station_id] = asked_at
+        prices = await fetch_fuel_prices(station_id, since)
+        if isinstance(prices, sqlite3.Error):
+            errors.append(prices)
+            continue
+        for fuel, rows in itertools.groupby(prices, key=lambda row: row[0]):
+            rows = list(rows)
+            sampled_at = array("I", [row[1] for row in rows])
+            _series[(station_id, fuel)] = PriceSeries(
+                sampled_at=sampled_at,
+                hour=array("B", _local_hours(sampled_at).tobytes()),
+                price=array("H", [row[2] for row in rows]))
+
+    result = await delete_fuel_prices_before(
+        [(station_id, fuel, since) for station_id in _stations for fuel in FUELS])
+    if result is not True:
+        errors.append(result)
+    return errors
+
+
+def is_tracked(station_id):
+    """
+    Returns whether the prices of the station are sampled
+    """
+    return station_id in _stations
+
+
+async def track_stations(stations):
+    """
+    Starts sampling the prices of stations a user asked for
+    and records the prices the user just got as first sample
+    If MAX_TRACKED_STATIONS are sampled already, the stations nobody asked for
+    the longest make room
+
+    Parameters:
+        stations: array of Station (fuel_api)
+
+    Returns:
+        True or sqlite Error
+    """
+    asked = {station.id: station for station in stations}
+    new_count = sum(1 for station_id in asked if station_id not in _stations)
+    evicted = []
+    if len(_stations) + new_count > MAX_TRACKED_STATIONS:
+        evicted = sorted((station_id for station_id in _stations if station_id not in asked),
+                         key=_asked_at.get)[:len(_stations) + new_count - MAX_TRACKED_STATIONS]
+        _untrack(evicted)
+
+    now = int(time.time())
+    asked_stations = list(asked.values())[:MAX_TRACKED_STATIONS]
+    rows = []
+    for station in asked_stations:
+        _stations[station.id] = f"{station.brand} - {station.name}"
+        _asked_at[station.id] = now
+        if not station.is_open:
+            continue
+        for fuel in FUELS:
+            price = _to_tenths_of_cent(getattr(station, fuel))
+            if price is not None:
+                _append(station.id, fuel, now, price)
+                rows.append((station.id, fuel, now, price))
+
+    if evicted:
+        result = await delete_fuel_stations(evicted)
+        if result is not True:
+            return result
+    result = await save_fuel_stations(
+        [(station.id, station.brand, station.name, now) for station in asked_stations])
+    if result is not True:
+        return result
+    return await save_fuel_prices(rows)
+
+
+async def _forget_old(now):
+    """
+    Stops sampling the stations nobody asked for within HISTORY_DAYS
+    and drops the samples which left the history window
+
+    Returns:
+        array of sqlite Errors of the queries which failed
+    """
+    since = now - HISTORY_SECONDS
+    errors = []
+    stale = [station_id for station_id, asked_at in _asked_at.items() if asked_at < since]
+    if stale:
+        _untrack(stale)
+        result = await delete_fuel_stations(stale)
+        if result is not True:
+            errors.append(result)
+
+    dropped = [(station_id, fuel, since)
+               for (station_id, fuel), series in _series.items() if series.drop_before(since)]
+    if dropped:
+        result = await delete_fuel_prices_before(dropped)
+        if result is not True:
+            errors.append(result)
+    return errors
+
+
+async def _fetch_prices(station_ids):
+    """
+    Calls the prices endpoint of the fuel api for up to STATIONS_PER_CALL stations
+
+    Returns:
+        dict station id -> prices of the station
+    """
+    url = ('https://creativecommons.tankerkoenig.de/json/prices.php'
+           f'?ids={",".join(station_ids)}'
+           f'&apikey={API_KEY}')
+    headers = {"accept": "application/json"}
+    status, reason, response_json = await get_json(url, headers=headers)
+
+    if not isinstance(response_json, dict) or not response_json.get("ok", False):
+        message = response_json.get("message") if isinstance(response_json, dict) else None
+        raise APIError(message or reason, status)
+    return response_json["prices"]
+
+
+async def sample_prices():
+    """
+    Records the current prices of all tracked stations which are open,
+    forgetting old samples and stations first
+
+    Returns:
+        array of errors (APIError or sqlite Error) of the calls which failed
+    """
+    errors = await _forget_old(int(time.time()))
+    station_ids = list(_stations)
+    for start in range(0, len(station_ids), STATIONS_PER_CALL):
+        try:
+            prices = await _fetch_prices(station_ids[start:start + STATIONS_PER_CALL])
+        except APIError as e:
+            errors.append(e)
+            continue
+
+        now = int(time.time())
+        rows = []
+        for station_id, station_prices in prices.items():
+            if station_prices.get("status") != "open":  # closed stations keep stale prices
+                continue
+            if station_id not in _stations:  # made room for another station meanwhile
+                continue
+            for fuel in FUELS:
+                price = _to_tenths_of_cent(station_prices.get(fuel))
+                if price is not None:
+                    _append(station_id, fuel, now, price)
+                    rows.append((station_id, fuel, now, price))
+        result = await save_fuel_prices(rows)
+        if result is not True:
+            errors.append(result)
+    return errors
+
+
+def get_price_stats(station_ids, fuel, since):
+    """
+    Computes min/avg/max and the cheapest hour of day of the stations since the given time
+
+    Parameters:
+        station_ids: ids of the stations
+        fuel: diesel, e5 or e10
+        since: epoch seconds where the window starts
+
+    Returns:
+        array of PriceStats for the stations with samples in the window
+    """
+    stats = []
+    for station_id in station_ids:
+        series = _series.get((station_id, fuel))
+        if series is None:
+            continue
+        # views on the arrays without copying - samples are ordered by time
+        sampled_at = np.frombuffer(series.sampled_at, dtype=np.uint32)
+        start = int(np.searchsorted(sampled_at, since))
+        prices = np.frombuffer(series.price, dtype=np.uint16)[start:]
+        if prices.size == 0:
+            continue
+        hours = np.frombuffer(series.hour, dtype=np.uint8)[start:]
+
+        samples_per_hour = np.bincount(hours, minlength=24)
+        price_per_hour = np.bincount(hours, weights=prices, minlength=24)
+        avg_per_hour = np.divide(price_per_hour, samples_per_hour,
+                                 out=np.full(24, np.inf), where=samples_per_hour > 0)
+        stats.append(PriceStats(
+            station=_stations.get(station_id, station_id),
+            samples=int(prices.size),
+            min=int(prices.min()) / 1000,
+            avg=float(prices.mean()) / 1000,
+            max=int(prices.max()) / 1000,
+            cheapest_hour=int(np.argmin(avg_per_hour))
+        ))
+    return stats
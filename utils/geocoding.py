@@ -1,14 +1,28 @@
 """ helper functions to resolve addresses and geolocations """
 
 import os
+import re
+import time
+import unicodedata
+import urllib.parse
+from collections import OrderedDict
 from dataclasses import dataclass
-import requests
 from dotenv import load_dotenv
+from utils.database import fetch_geocode, save_geocode
 from utils.exceptions import APIError
+from utils.helper import get_json
 
 load_dotenv()
 API_KEY = os.environ.get("GEOCODE_API_KEY")
 
+# addresses which could not be resolved are cached this long
+FAILED_LOOKUP_TTL_SECONDS = 10 * 60
+# number of addresses kept in memory in front of the db cache
+MEMORY_CACHE_SIZE = 1024
+
+# normalized address -> (lat, lng, expires_at), least recently used first
+_memory_cache = OrderedDict()
+
 
 @dataclass
 class Geolocation:
@@ -20,22 +34,78 @@ class Geolocation:
     lng: str = None
 
 
-def resolve_address(address: str):
+def normalize_address(address: str):
     """
-    Calls the geocoding api and resolves the address to latlng
+    Normalizes an address so different spellings share one cache entry
+    (case, whitespace, commas, umlauts and ß - e.g. "Große Straße 1, München"
+    and "grosse strasse 1 muenchen")
+
+    Parameters:
+        address: address as typed by the user
+
+    Returns:
+        normalized address
+    """
+    text = unicodedata.normalize("NFC", address).casefold()  # casefold also turns ß into ss
+    for umlaut, replacement in (("ä", "ae"), ("ö", "oe"), ("ü", "ue")):
+        text = text.replace(umlaut, replacement)
+    return " ".join(re.sub(r"[,;]", " ", text).split())
+
+
+def _remember(query, lookup):
+    _memory_cache[query] = lookup
+    _memory_cache.move_to_end(query)
+    if len(_memory_cache) > MEMORY_CACHE_SIZE:
+        _memory_cache.popitem(last=False)
+
+
+async def _cached_lookup(query):
+    """
+    Returns the cached (lat, lng, expires_at) of the address from memory or the db
+    """
+    lookup = _memory_cache.get(query)
+    if lookup is None:
+        lookup = await fetch_geocode(query)
+        if not isinstance(lookup, tuple):  # not cached or db error - ask the api
+            return None
+    if lookup[2] is not None and lookup[2] <= time.time():  # expired failed lookup
+        _memory_cache.pop(query, None)
+        return None
+    _remember(query, lookup)
+    return lookup
+
+
+async def resolve_address(address: str):
+    """
+    Resolves the address to latlng, repeated addresses are answered from the cache
+    Only calls the geocoding api if the address is not cached
 
     Returns:
         lat lng object
     """
-    url = f'https://geocode.maps.co/search?q={address}&api_key={API_KEY}'  # pylint: disable=duplicate-code
+    query = normalize_address(address)
+    lookup = await _cached_lookup(query)
+    if lookup is not None:
+        if lookup[0] is None:
+            raise APIError(f"address {address} not found", 404)
+        return Geolocation(address=address, lat=lookup[0], lng=lookup[1])
+
+    url = (f'https://geocode.maps.co/search?q={urllib.parse.quote(address)}'
+           f'&api_key={API_KEY}')  # pylint: disable=duplicate-code
     headers = {"accept": "application/json"}
-    response = requests.get(url, headers=headers, timeout=4)
-    response_json = response.json()
+    status, reason, response_json = await get_json(url, headers=headers)
+
+    if status == 200 and response_json:
+        lookup = (response_json[0]["lat"], response_json[0]["lon"], None)
+        _remember(query, lookup)
+        await save_geocode(query, *lookup)
+        return Geolocation(address=address, lat=lookup[0], lng=lookup[1])
 
-    if response.status_code == 200:
-        return Geolocation(
-            address=address,
-            lat=response_json[0]["lat"], lng
-            =response_json[0]["lon"])
+    if status == 200:  # no result - remember the failed lookup for a while
+        lookup = (None, None, int(time.time()) + FAILED_LOOKUP_TTL_SECONDS)
+        _remember(query, lookup)
+        await save_geocode(query, *lookup)
+        raise APIError(f"address {address} not found", 404)
 
-    raise APIError(response_json["message"], response.status_code)
+    message = response_json.get("message") if isinstance(response_json, dict) else None
+    raise APIError(message or reason, status)
@@ -1 +1,121 @@
 """ different small helper functions for all modules """
+
+import asyncio
+import aiohttp
+from utils.exceptions import APIError
+
+# max parallel connections to one host, so no api or shop gets hammered
+MAX_CONNECTIONS_PER_HOST = 4
+DEFAULT_TIMEOUT_SECONDS = 10
+
+_session = None  # pylint: disable=invalid-name
+
+
+def get_session():
+    """
+    Returns the aiohttp session shared by all helpers (one connection pool for the bot)
+    Is created on first use, so it has to be called from within the event loop
+
+    Returns:
+        aiohttp.ClientSession
+    """
+    global _session  # pylint: disable=global-statement
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=MAX_CONNECTIONS_PER_HOST),
+            timeout=aiohttp.ClientTimeout(total=DEFAULT_TIMEOUT_SECONDS))
+    return _session
+
+
+async def get_json(url, headers=None, timeout=4):
+    """
+    Sends a GET request with the shared session and parses the json response
+
+    Parameters:
+        url: url of the api
+        headers: request headers (optional)
+        timeout: timeout in seconds
+
+    Returns:
+        response status, response reason, response json
+
+    Raises:
+        APIError if the request itself failed (no connection, timeout ...)
+    """
+    try:
+        async with get_session().get(
+                url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            return response.status, response.reason, await response.json(content_type=None)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        raise APIError(repr(e), None) from e
+
+
+async def get_json_if_changed(url, etag=None, last_modified=None, timeout=4):
+    """
+    Sends a conditional GET request with the validators of the last response,
+    so an unchanged resource is not downloaded and parsed again
+
+    Parameters:
+        url: url of the api
+        etag: ETag of the last response (optional)
+        last_modified: Last-Modified of the last response (optional)
+        timeout: timeout in seconds
+
+    Returns:
+        response status, response reason, response json (None if unchanged - 304),
+        ETag and Last-Modified of the response
+
+    Raises:
+        APIError if the request itself failed (no connection, timeout ...)
+    """
+    headers = {"accept": "application/json"}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    try:
+        async with get_session().get(
+                url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            response_json = None
+            if response.status != 304:
+                response_json = await response.json(content_type=None)
+            return (response.status, response.reason, response_json,
+                    response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        raise APIError(repr(e), None) from e
+
+
+def single_flight(pending_fetches, key, fetch):
+    """
+    Returns the running fetch for the key or starts it, so concurrent calls share one request
+    The fetch is shielded - a cancelled caller must not cancel the fetch the others wait for
+
+    Parameters:
+        pending_fetches: dict of the running fetches of the module (key -> task)
+        key: what is fetched
+        fetch: coroutine function starting the fetch
+
+    Returns:
+        awaitable result of the fetch
+    """
+    pending = pending_fetches.get(key)
+    if pending is None:
+        pending = asyncio.ensure_future(fetch())
+        pending_fetches[key] = pending
+        pending.add_done_callback(lambda _: pending_fetches.pop(key, None))
+    return asyncio.shield(pending)
+
+
+async def wait_for_event(event, timeout):
+    """
+    Clears the event and waits until it is set again or the timeout is over
+
+    Parameters:
+        event: asyncio.Event
+        timeout: seconds or None to wait without timeout
+    """
+    event.clear()
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
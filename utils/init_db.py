@@ -1,45 +1,258 @@
-"""" file to init the database used by the bot """
+"""" file to init and migrate the database used by the bot """
 
 import os
 import sqlite3
 from dotenv import load_dotenv
 
-# env variables
-load_dotenv()
-db_path = os.environ.get("DATABASE")
 
-# set up db connection
-con = sqlite3.connect(db_path)
-cur = con.cursor()
+def create_tables(cur):
+    """
+    Migration 1 - creates the reminder and bike tables
+    """
+    # reminder table
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS reminder (
+            topic TEXT NOT NULL,
+            date TEXT NOT NULL,
+            channel_id INTEGER NOT NULL,
+            sender TEXT NOT NULL
+        );
+        """
+    )
+
+    # canyon table
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS bike (
+            name TEXT NOT NULL,
+            variant TEXT NOT NULL,
+            url TEXT NOT NULL,
+            channel_id INTEGER NOT NULL,
+            sender TEXT NOT NULL
+        );
+        """
+    )
+
+
+def add_bike_muted(cur):
+    """
+    Migration 2 - adds the muted column to the bike table
+    (databases created before the migrations existed may already have it)
+    """
+    columns = [column[1] for column in cur.execute("PRAGMA table_info(bike);")]
+    if "muted" not in columns:
+        cur.execute(
+            """
+            ALTER TABLE bike
+            ADD muted BOOL NOT NULL DEFAULT false;
+            """
+        )
+
+
+def reminder_due_at(cur):
+    """
+    Migration 3 - stores reminder dates as epoch seconds and adds indexes
+    """
+    cur.execute(
+        """
+        CREATE TABLE reminder_new (
+            topic TEXT NOT NULL,
+            due_at INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            sender TEXT NOT NULL
+        );
+        """
+    )
+    # dates were stored as local time strings (e.g. 2024-05-01 18:30:00)
+    cur.execute(
+        """
+        INSERT INTO reminder_new (topic, due_at, channel_id, sender)
+        SELECT topic, CAST(strftime('%s', date, 'utc') AS INTEGER), channel_id, sender
+        FROM reminder;
+        """
+    )
+    cur.execute("DROP TABLE reminder;")
+    cur.execute("ALTER TABLE reminder_new RENAME TO reminder;")
+    cur.execute("CREATE INDEX reminder_due_at ON reminder (due_at);")
+    cur.execute(
+        "CREATE INDEX reminder_channel_sender ON reminder (channel_id, sender);")
+    cur.execute("CREATE INDEX bike_channel_sender ON bike (channel_id, sender);")
+
+
+def bike_page_state(cur):
+    """
+    Migration 4 - adds a table with the last known state of every watched shop page
+    """
+    cur.execute(
+        """
+        CREATE TABLE bike_page (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            content_hash TEXT,
+            availability TEXT NOT NULL DEFAULT '{}'
+        );
+        """
+    )
+
+
+def bike_url_index(cur):
+    """
+    Migration 5 - adds an index to look up the watchers of a shop page
+    """
+    cur.execute("CREATE INDEX bike_url ON bike (url);")
+
 
-# reminder table
-cur.execute(
+def geocode_cache(cur):
     """
-    CREATE TABLE IF NOT EXISTS reminder (
-        topic TEXT NOT NULL,
-        date TEXT NOT NULL,
-        channel_id INTEGER NOT NULL,
-        sender TEXT NOT NULL
-    );
+    Migration 6 - adds a cache for resolved addresses
+    (failed lookups have no coordinates and expire)
     """
-)
+    cur.execute(
+        """
+        CREATE TABLE geocode (
+            query TEXT PRIMARY KEY,
+            lat TEXT,
+            lng TEXT,
+            expires_at INTEGER
+        );
+        """
+    )
 
-# canyon table
-cur.execute(
+
+def fuel_price_history(cur):
+    """
+    Migration 7 - adds the stations whose prices are sampled and their price history
+    (prices in tenths of a cent)
+    """
+    cur.execute(
+        """
+        CREATE TABLE fuel_station (
+            id TEXT PRIMARY KEY,
+            brand TEXT,
+            name TEXT
+        );
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE fuel_price (
+            station_id TEXT NOT NULL,
+            fuel TEXT NOT NULL,
+            sampled_at INTEGER NOT NULL,
+            price INTEGER NOT NULL,
+            PRIMARY KEY (station_id, fuel, sampled_at)
+        ) WITHOUT ROWID;
+        """
+    )
+
+
+def news_subscriptions(cur):
+    """
+    Migration 8 - adds the channels subscribed to news topics (ressort or breaking)
+    and the 64 bit hashes of the news already delivered per topic
+    """
+    cur.execute(
+        """
+        CREATE TABLE news_subscription (
+            channel_id INTEGER NOT NULL,
+            topic TEXT NOT NULL,
+            PRIMARY KEY (channel_id, topic)
+        );
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE news_delivered (
+            topic TEXT PRIMARY KEY,
+            news_hashes BLOB NOT NULL
+        );
+        """
+    )
+
+
+def bike_notified(cur):
+    """
+    Migration 9 - remembers per watcher whether it was told that its variant is available
+    (variants which are available right now count as told, so nobody is notified twice)
     """
-    CREATE TABLE IF NOT EXISTS bike (
-        name TEXT NOT NULL,
-        variant TEXT NOT NULL,
-        url TEXT NOT NULL,
-        channel_id INTEGER NOT NULL,
-        sender TEXT NOT NULL
-    );
+    cur.execute(
+        """
+        ALTER TABLE bike
+        ADD notified BOOL NOT NULL DEFAULT false;
+        """
+    )
+    cur.execute(
+        """
+        UPDATE bike SET notified = true
+        WHERE EXISTS (
+            SELECT 1 FROM bike_page
+            WHERE bike_page.url = bike.url
+            AND json_extract(bike_page.availability, '$."' || bike.variant || '"') = 1
+        );
+        """
+    )
+
+
+def fuel_station_asked_at(cur):
+    """
+    Migration 10 - remembers when a user last asked for a sampled station,
+    stations nobody asks for anymore are not sampled (the known ones start as asked now)
     """
-)
+    cur.execute(
+        """
+        ALTER TABLE fuel_station
+        ADD asked_at INTEGER NOT NULL DEFAULT 0;
+        """
+    )
+    cur.execute(
+        """
+        UPDATE fuel_station SET asked_at = CAST(strftime('%s', 'now') AS INTEGER);
+        """
+    )
+
+
+# new migrations are appended here, the position in the list is the schema version
+MIGRATIONS = [
+    create_tables,
+    add_bike_muted,
+    reminder_due_at,
+    bike_page_state,
+    bike_url_index,
+    geocode_cache,
+    fuel_price_history,
+    news_subscriptions,
+    bike_notified,
+    fuel_station_asked_at,
+]
 
-cur.execute(
+
+def run_migrations(con):
     """
-    ALTER TABLE bike
-    ADD muted BOOL NOT NULL DEFAULT false;
+    Brings the database schema up to date
+    The current schema version is tracked in PRAGMA user_version,
+    every migration runs in its own transaction
+
+    Parameters:
+        con: sqlite3 connection of the database
     """
-)
+    cur = con.cursor()
+    version = cur.execute("PRAGMA user_version;").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        cur.execute("BEGIN;")
+        try:
+            migration(cur)
+            cur.execute(f"PRAGMA user_version = {number};")
+            con.commit()
+        except sqlite3.Error:
+            con.rollback()
+            raise
+
+
+if __name__ == "__main__":
+    # env variables
+    load_dotenv()
+    db_path = os.environ.get("DATABASE")
+
+    run_migrations(sqlite3.connect(db_path))
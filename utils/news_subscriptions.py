@@ -0,0 +1,145 @@
+""" channels subscribed to news topics and the news which were already delivered to them """
+
+import hashlib
+from array import array
+from collections import defaultdict
+from utils.database import (
+    add_news_subscription, delete_news_subscription, save_delivered_news)
+from utils.tagesschau import Ressort, get_feed
+
+BREAKING_NEWS = "breaking"
+TOPICS = [ressort.value for ressort in Ressort] + [BREAKING_NEWS]
+# hashes of the newest delivered news kept per topic - more than one feed holds,
+# so news which drop out of a feed and come back are not posted twice
+MAX_DELIVERED_PER_TOPIC = 256
+
+_subscribers = defaultdict(set)  # topic -> channel ids
+_delivered = {}  # topic -> array of 64 bit hashes of the delivered news, oldest first
+
+
+def news_hash(news):
+    """
+    Returns a 64 bit hash of the news id
+    """
+    digest = hashlib.blake2b((news.id or news.title).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def load_subscriptions(subscriptions, delivered):
+    """
+    Loads the subscriptions and the delivered news from the database (called once on startup)
+
+    Parameters:
+        subscriptions: array of (channel_id, topic)
+        delivered: array of (topic, news_hashes as bytes)
+    """
+    for channel_id, topic in subscriptions:
+        _subscribers[topic].add(channel_id)
+    for topic, news_hashes in delivered:
+        _delivered[topic] = array("q", news_hashes)
+
+
+async def subscribe(channel_id, topic):
+    """
+    Subscribes the channel to a topic, it gets news published from now on
+
+    Parameters:
+        channel_id: channel which gets the news
+        topic: ressort or breaking
+
+    Returns:
+        True or sqlite Error
+    """
+    resp = await add_news_subscription(channel_id, topic)
+    if resp is True:
+        _subscribers[topic].add(channel_id)
+    return resp
+
+
+async def unsubscribe(channel_id, topic):
+    """
+    Unsubscribes the channel from a topic
+
+    Parameters:
+        channel_id: channel which got the news
+        topic: ressort or breaking
+
+    Returns:
+        True or sqlite Error
+    """
+    resp = await delete_news_subscription(channel_id, topic)
+    if resp is True:
+        _subscribers[topic].discard(channel_id)
+    return resp
+
+
+def _new_news(topic, news):
+    """
+    Diffs the news of a topic against the delivered ones and remembers the new ones as delivered
+    The first time a topic is seen its news are only remembered, so nothing old gets posted
+
+    Parameters:
+        topic: ressort or breaking
+        news: array of News, newest first
+
+    Returns:
+        array of (hash, News) which were not delivered yet, oldest first
+    """
+    hashes = [news_hash(n) for n in news]
+    delivered = _delivered.get(topic)
+    if delivered is None:
+        _delivered[topic] = array("q", reversed(hashes[:MAX_DELIVERED_PER_TOPIC]))
+        return []
+
+    known = set(delivered)
+    new_news = []
+    for news_hash_, n in zip(reversed(hashes), reversed(news)):
+        if news_hash_ not in known:
+            known.add(news_hash_)
+            new_news.append((news_hash_, n))
+            delivered.append(news_hash_)
+    del delivered[:-MAX_DELIVERED_PER_TOPIC]
+    return new_news
+
+
+async def collect_news_deliveries():
+    """
+    Diffs the news of every refreshed ressort once against the delivered news
+    and hands the new ones to every subscribed channel
+    Breaking news of all ressorts are delivered to the channels subscribed to breaking
+
+    Returns:
+        dict channel id -> array of News to post (oldest first)
+        array of sqlite errors
+    """
+    news_by_topic = {}
+    breaking_news = []
+    for ressort in Ressort:
+        feed = get_feed(ressort)
+        if feed.refreshed_at is None or feed.stale:
+            continue
+        news_by_topic[ressort.value] = feed.news
+        breaking_news.extend(n for n in feed.news if n.breaking_news)
+    # breaking news are only diffed when every ressort is up to date,
+    # otherwise the first run could not remember the breaking news of a missing ressort
+    if len(news_by_topic) == len(Ressort):
+        news_by_topic[BREAKING_NEWS] = breaking_news
+
+    deliveries = defaultdict(dict)  # channel id -> hash -> News (a channel gets a news once)
+    changed_topics = []
+    for topic, news in news_by_topic.items():
+        seeded = topic not in _delivered
+        new_news = _new_news(topic, news)
+        if seeded or new_news:
+            changed_topics.append(topic)
+        for channel_id in _subscribers[topic]:
+            for news_hash_, n in new_news:
+                deliveries[channel_id].setdefault(news_hash_, n)
+
+    errors = []
+    resp = await save_delivered_news(
+        [(topic, _delivered[topic].tobytes()) for topic in changed_topics])
+    if resp is not True:
+        errors.append(resp)
+    return ({channel_id: list(news.values()) for channel_id, news in deliveries.items()},
+            errors)
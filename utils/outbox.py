@@ -0,0 +1,97 @@
+""" outgoing messages of the background tasks - queued, merged and sent per channel """
+
+import asyncio
+import heapq
+import itertools
+import logging
+from enum import IntEnum
+
+# a message can carry at most 10 embeds with at most 6000 characters together
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_MESSAGE_CHARACTERS = 6000
+
+logger = logging.getLogger("discord")
+
+
+class Priority(IntEnum):
+    """ Enum for the priority of outgoing embeds - lower values are sent first """
+    REMINDER = 0
+    BIKE = 1
+    NEWS = 2
+
+
+_queues = {}  # channel id -> heap of (priority, sequence number, embed, future of the embed)
+_workers = {}  # channel id -> task sending the queued embeds of the channel
+_sequence = itertools.count()  # keeps the order of embeds with the same priority
+
+
+def enqueue_embeds(channel, embeds, priority: Priority):
+    """
+    Queues embeds for a channel and returns right away, the embeds are sent in the background
+    Every channel has its own worker, so a channel which is rate limited by discord
+    only delays its own messages
+
+    Parameters:
+        channel: channel the embeds are posted in
+        embeds: array of discord.Embed
+        priority: priority of the embeds
+
+    Returns:
+        asyncio.Future - resolves to True once all embeds were sent,
+        False if one of them could not be sent (the error is logged)
+    """
+    loop = asyncio.get_running_loop()
+    queue = _queues.setdefault(channel.id, [])
+    futures = []
+    for embed in embeds:
+        future = loop.create_future()
+        heapq.heappush(queue, (priority, next(_sequence), embed, future))
+        futures.append(future)
+    worker = _workers.get(channel.id)
+    if worker is None or worker.done():
+        _workers[channel.id] = loop.create_task(_send_queued(channel))
+    delivery = loop.create_future()
+    gathered = asyncio.gather(*futures)
+    gathered.add_done_callback(lambda _: delivery.set_result(all(gathered.result())))
+    return delivery
+
+
+def _next_message(queue):
+    """
+    Pops the embeds of the next message from the heap, as many as fit into one message
+    (an embed which is too long on its own is still tried alone, discord reports the error)
+
+    Returns:
+        array of heap items
+    """
+    items = [heapq.heappop(queue)]
+    characters = len(items[0][2])
+    while (queue and len(items) < MAX_EMBEDS_PER_MESSAGE
+           and characters + len(queue[0][2]) <= MAX_MESSAGE_CHARACTERS):
+        characters += len(queue[0][2])
+        items.append(heapq.heappop(queue))
+    return items
+
+
+async def _send_queued(channel):
+    """
+    Sends the queued embeds of the channel, merging as many embeds into one message
+    as discord allows, until the queue is empty
+    Waiting for rate limits is left to discord.py, which follows the buckets of the api
+    """
+    queue = _queues[channel.id]
+    while queue:
+        items = _next_message(queue)
+        sent = False
+        try:
+            await channel.send(embeds=[item[2] for item in items])
+            sent = True
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # also network errors, the worker has to go on with the rest of the queue
+            logger.error("Outbox: channel %s - Error: %s",
+                         channel.id, e)
+        finally:  # also if the worker is cancelled, nobody waits forever
+            for item in items:
+                item[3].set_result(sent)
+    del _queues[channel.id]
+    del _workers[channel.id]
@@ -1,11 +1,17 @@
-""" reddit helper functions to interact with reddit api via praw """
+""" reddit helper functions to interact with the reddit api (app-only oauth) """
 
+import asyncio
+import hashlib
 import os
 import random
-import praw
-from praw.models import Subreddit
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+import aiohttp
 from dotenv import load_dotenv
-from utils.exceptions import SubredditNotFoundOrEmptyError
+from utils.exceptions import SubredditNotFoundOrEmptyError, APIError
+from utils.helper import get_session, single_flight
 
 load_dotenv()
 
@@ -13,29 +19,224 @@ CLIENT_ID = os.environ.get("REDDIT_CLIENT_ID")
 CLIENT_SECRET = os.environ.get("REDDIT_CLIENT_SECRET")
 USER_AGENT = os.environ.get("REDDIT_USER_AGENT")
 
-reddit = praw.Reddit(
-    client_id=CLIENT_ID,
-    client_secret=CLIENT_SECRET,
-    user_agent=USER_AGENT
-)
+# number of hot posts fetched per page and how long the cached pages are fresh
+LISTING_SIZE = 50
+LISTING_TTL_SECONDS = 10 * 60
+# deeper pages are only fetched if a channel has seen every cached post, up to this many posts
+MAX_LISTING_POSTS = 250
+# posts shown in a channel are remembered in two bloom filters of SEEN_FILTER_BITS bits:
+# after SEEN_FILTER_CAPACITY posts the older filter is dropped and a new one is started,
+# so memory stays the same no matter how many channels use the command
+# (about 1% false positives - a post is skipped although it was not shown)
+SEEN_FILTER_CAPACITY = 10_000
+SEEN_FILTER_BITS = 96_000
+SEEN_FILTER_HASHES = 7
+# subreddits asked for at least POPULAR_MIN_REQUESTS times (decaying) are refreshed
+# in the background before their listing expires, at most POPULAR_MAX_SUBREDDITS of them
+REFRESH_INTERVAL_MINUTES = 5
+POPULAR_MIN_REQUESTS = 2
+POPULAR_MAX_SUBREDDITS = 5
+# what reddit allows as subreddit name, anything else is not sent to the api
+SUBREDDIT_NAME = re.compile(r"^[A-Za-z0-9_]{2,21}$")
+# the access token is renewed this long before it expires
+TOKEN_EXPIRY_MARGIN_SECONDS = 60
 
+_token = None  # (access token, expires at) pylint: disable=invalid-name
+_token_lock = asyncio.Lock()
+_listings = {}  # subreddit -> Listing
+_pending_fetches = {}  # (subreddit, after) -> running fetch
+_demand = Counter()  # subreddit -> requests, halved every background refresh
+# current and previous filter of shown (channel, post) pairs
+_seen_filters = [bytearray(SEEN_FILTER_BITS // 8), bytearray(SEEN_FILTER_BITS // 8)]
+_seen_count = 0  # pylint: disable=invalid-name
 
-def get_post(subredditname):
+
+@dataclass
+class Listing:
+    """
+    Class containing the cached hot posts of a subreddit
+    """
+    posts: list = field(default_factory=list)  # (post id, url)
+    after: str = None  # token of the next page, None if there is none
+    expires_at: float = 0
+
+
+async def _access_token():
+    """
+    Returns an app-only access token, a new one is requested if there is none or it expires soon
+    """
+    global _token  # pylint: disable=global-statement
+    async with _token_lock:
+        if _token is not None and _token[1] > time.time():
+            return _token[0]
+        try:
+            async with get_session().post(
+                    "https://www.reddit.com/api/v1/access_token",
+                    data={"grant_type": "client_credentials"},
+                    auth=aiohttp.BasicAuth(CLIENT_ID or "", CLIENT_SECRET or ""),
+                    headers={"User-Agent": USER_AGENT or "mxsti-bot"}) as response:
+                response_json = await response.json(content_type=None)
+                if response.status != 200 or "access_token" not in response_json:
+                    raise APIError(response_json.get("message", response.reason), response.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise APIError(repr(e), None) from e
+        _token = (response_json["access_token"],
+                  time.time() + response_json.get("expires_in", 3600) - TOKEN_EXPIRY_MARGIN_SECONDS)
+        return _token[0]
+
+
+def _bit_positions(channel_id, post_id):
+    digest = hashlib.blake2b(f"{channel_id}/{post_id}".encode(), digest_size=16).digest()
+    first, second = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big")
+    return [(first + i * second) % SEEN_FILTER_BITS for i in range(SEEN_FILTER_HASHES)]
+
+
+def _was_shown(channel_id, post_id):
+    """
+    Returns whether the post was (probably) shown in the channel recently
+    """
+    positions = _bit_positions(channel_id, post_id)
+    return any(all(seen[position // 8] & 1 << position % 8 for position in positions)
+               for seen in _seen_filters)
+
+
+def _remember_shown(channel_id, post_id):
+    """
+    Remembers that the post was shown in the channel, starts a new filter if the current one is full
+    """
+    global _seen_count  # pylint: disable=global-statement
+    if _seen_count >= SEEN_FILTER_CAPACITY:
+        _seen_filters.insert(0, bytearray(SEEN_FILTER_BITS // 8))
+        _seen_filters.pop()
+        _seen_count = 0
+    for position in _bit_positions(channel_id, post_id):
+        _seen_filters[0][position // 8] |= 1 << position % 8
+    _seen_count += 1
+
+
+async def _fetch_page(subreddit, after=None):
+    """
+    Calls the reddit api for one page of the hot posts of the subreddit
+
+    Returns:
+        array of (post id, url), token of the next page
+    """
+    headers = {
+        "Authorization": f"bearer {await _access_token()}",
+        "User-Agent": USER_AGENT or "mxsti-bot"}
+    url = f"https://oauth.reddit.com/r/{subreddit}/hot?limit={LISTING_SIZE}&raw_json=1"
+    if after:
+        url += f"&after={after}"
+    try:
+        # unknown subreddits are redirected to the search
+        async with get_session().get(url, headers=headers, allow_redirects=False) as response:
+            if response.status in (301, 302, 403, 404):
+                raise SubredditNotFoundOrEmptyError(subreddit)
+            if response.status != 200:
+                raise APIError(response.reason, response.status)
+            response_json = await response.json(content_type=None)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        raise APIError(repr(e), None) from e
+
+    try:
+        posts = [(post["data"]["name"], post["data"]["url"])
+                 for post in response_json["data"]["children"]]
+        return posts, response_json["data"].get("after")
+    except (KeyError, TypeError) as e:
+        raise APIError(f"unexpected response {e!r}", 200) from e
+
+
+async def _fetch_listing(subreddit):
+    """
+    Fetches the first page of hot posts of the subreddit and caches it
+
+    Returns:
+        Listing
+    """
+    posts, after = await _fetch_page(subreddit)
+    now = time.time()
+    for expired in [name for name, cached in _listings.items() if cached.expires_at <= now]:
+        del _listings[expired]
+    listing = Listing(posts=posts, after=after, expires_at=now + LISTING_TTL_SECONDS)
+    _listings[subreddit] = listing
+    return listing
+
+
+async def _extend_listing(subreddit, listing):
+    """
+    Fetches the next page of hot posts and appends it to the cached listing
+    """
+    after = listing.after
+    posts, listing.after = await _fetch_page(subreddit, after)
+    known = {post_id for post_id, _ in listing.posts}
+    listing.posts.extend(post for post in posts if post[0] not in known)
+    return listing
+
+
+async def get_post(subredditname, channel_id):
     """
     Returns random hot post from given subreddit using the reddit api
+    Posts recently shown in the channel are skipped, if the channel has seen
+    every cached post the next page of the listing is fetched
+    The hot posts are cached, so repeated calls pick from memory
 
     Parameters:
         subredditname: Name of the subreddit
+        channel_id: channel the post is shown in
 
     Returns:
-        post url: the URL of a random post    
+        post url: the URL of a random post
+
+    Raises:
+        SubredditNotFoundOrEmptyError if the name is no subreddit name,
+            the subreddit does not exist or has no posts
+        APIError if reddit could not be reached
     """
-    subreddit: Subreddit = reddit.subreddit(subredditname)
-    posts = []
-    try:
-        for post in subreddit.hot(limit=10):
-            posts.append(post.url)
-    except Exception as e:
-        raise SubredditNotFoundOrEmptyError(subredditname) from e
+    if not SUBREDDIT_NAME.fullmatch(subredditname):
+        raise SubredditNotFoundOrEmptyError(subredditname)
+    subreddit = subredditname.casefold()
+    _demand[subreddit] += 1
+    listing = _listings.get(subreddit)
+    if listing is None or listing.expires_at <= time.time():
+        listing = await single_flight(
+            _pending_fetches, (subreddit, None), lambda: _fetch_listing(subreddit))
+
+    unseen = [post for post in listing.posts if not _was_shown(channel_id, post[0])]
+    while not unseen and listing.after and len(listing.posts) < MAX_LISTING_POSTS:
+        try:
+            await single_flight(_pending_fetches, (subreddit, listing.after),
+                                lambda: _extend_listing(subreddit, listing))
+        except APIError:
+            break  # show an already shown post instead of nothing
+        unseen = [post for post in listing.posts if not _was_shown(channel_id, post[0])]
+
+    if not listing.posts:
+        raise SubredditNotFoundOrEmptyError(subredditname)
+    # every post was shown already - repeat one instead of showing nothing
+    post_id, url = random.choice(unseen or listing.posts)
+    _remember_shown(channel_id, post_id)
+    return url
+
+
+async def refresh_popular_subreddits():
+    """
+    Refreshes the listings of the most requested subreddits which would expire
+    before the next background refresh, so they are never fetched while a user waits
+
+    Returns:
+        array of errors of the subreddits which could not be refreshed
+    """
+    refresh_before = time.time() + REFRESH_INTERVAL_MINUTES * 60
+    popular = [subreddit for subreddit, requests in _demand.most_common(POPULAR_MAX_SUBREDDITS)
+               if requests >= POPULAR_MIN_REQUESTS]
+    # older requests count less, subreddits nobody asks for anymore drop out
+    for subreddit in list(_demand):
+        _demand[subreddit] //= 2
+        if not _demand[subreddit]:
+            del _demand[subreddit]
 
-    return random.choice(posts)
+    due = [subreddit for subreddit in popular
+           if subreddit not in _listings or _listings[subreddit].expires_at <= refresh_before]
+    results = await asyncio.gather(
+        *(_fetch_listing(subreddit) for subreddit in due), return_exceptions=True)
+    return [result for result in results if isinstance(result, Exception)]
@@ -0,0 +1,59 @@
+""" in-memory scheduler that knows when the next reminder is due """
+
+import asyncio
+import heapq
+import time
+from utils.helper import wait_for_event
+
+# upper bound for one sleep so jumps of the wall clock (e.g. after suspend) are noticed
+MAX_SLEEP_SECONDS = 60
+
+# min-heap of due times (epoch seconds) - the reminders themselves stay in the db
+_heap = []
+_changed = asyncio.Event()
+
+
+def load_reminders(due_times):
+    """
+    Replaces all scheduled due times with the given ones from the database
+    Is called once on startup - due times in the past are due immediately,
+    so reminders missed while the bot was offline are sent right away
+
+    Parameters:
+        due_times: array of epoch seconds
+    """
+    _heap[:] = due_times
+    heapq.heapify(_heap)
+    _changed.set()
+
+
+def schedule_reminder(due_at):
+    """
+    Adds a due time to the scheduler and wakes up a waiting loop
+
+    Parameters:
+        due_at: epoch seconds when a reminder is due
+    """
+    heapq.heappush(_heap, due_at)
+    _changed.set()
+
+
+async def wait_for_due_reminders():
+    """
+    Sleeps until at least one reminder is due
+
+    Returns:
+        int - current time in epoch seconds, every reminder due until then should be sent
+    """
+    while True:
+        now = int(time.time())
+        if _heap and _heap[0] <= now:
+            while _heap and _heap[0] <= now:
+                heapq.heappop(_heap)
+            return now
+
+        # sleep until the next reminder is due or a new one is scheduled
+        timeout = None
+        if _heap:
+            timeout = min(_heap[0] - time.time(), MAX_SLEEP_SECONDS)
+        await wait_for_event(_changed, timeout)
@@ -1,9 +1,22 @@
 """ helper functions to interact with tagesschau api """
 
-from dataclasses import dataclass
+import asyncio
+from dataclasses import dataclass, field
+from datetime import datetime, time, timedelta
 from enum import Enum
-import requests
+from zoneinfo import ZoneInfo
 from utils.exceptions import APIError
+from utils.helper import get_json, get_json_if_changed
+
+# the news of all ressorts are refreshed in the background this often
+REFRESH_INTERVAL_MINUTES = 5
+# the tagesschau is broadcast daily at 20:00 in Berlin (local time, so the offset changes with DST)
+TIMEZONE = ZoneInfo("Europe/Berlin")
+BROADCAST_TIME = time(20, 0)
+# the video of a broadcast is refreshed this long after it started
+VIDEO_REFRESH_TIME = time(20, 5, tzinfo=TIMEZONE)
+# the api is asked again after this long if it does not have the latest broadcast yet
+VIDEO_RETRY_SECONDS = 5 * 60
 
 
 class Ressort(Enum):
@@ -22,13 +35,31 @@ class News:
     """
     Class containing news metadata
     """
+    id: str = None
     title: str = None
     details_web: str = None
     breaking_news: bool = None
     teaser_image_url: str = None
 
 
-def get_latest_tagesschau_channels():
+@dataclass
+class NewsFeed:
+    """
+    Class containing the latest news of a ressort and the state of its last refresh
+    """
+    news: list = field(default_factory=list)
+    etag: str = None
+    last_modified: str = None
+    refreshed_at: datetime = None  # last successful refresh
+    stale: bool = False  # the last refresh failed, news are from refreshed_at
+
+
+_feeds = {ressort: NewsFeed() for ressort in Ressort}
+_video = None  # (url, expires at) pylint: disable=invalid-name
+_video_lock = asyncio.Lock()
+
+
+async def get_latest_tagesschau_channels():
     """
     Calls the tagesschau api and grabs the latest info for the tagesschau channels
 
@@ -36,88 +67,179 @@ def get_latest_tagesschau_channels():
         response JSON from the tagesschau api
     """
     url = 'https://www.tagesschau.de/api2u/channels/'
-    headers = {"accept": "application/json"} # pylint: disable=duplicate-code
-    response = requests.get(url, headers=headers, timeout=4)
-    response_json = response.json()
+    headers = {"accept": "application/json"}  # pylint: disable=duplicate-code
+    status, reason, response_json = await get_json(url, headers=headers)
 
-    if response.status_code == 200:
+    if status == 200:
         return response_json
 
-    raise APIError(response_json["error"], response.status_code)
+    error = response_json.get("error") if isinstance(response_json, dict) else None
+    raise APIError(error or reason, status)
+
 
+def _create_news_object(news_data):
+    teaser_image = news_data.get("teaserImage") or {}
+    return News(
+        id=news_data.get("sophoraId") or news_data.get("externalId") or news_data.get("detailsweb"),
+        title=news_data["title"],
+        teaser_image_url=teaser_image.get("imageVariants", {}).get("1x1-144"),
+        details_web=news_data.get("detailsweb"),
+        breaking_news=news_data.get("breakingNews", False))
 
-def get_news(ressort: Ressort):
+
+async def _refresh_feed(ressort: Ressort):
     """
-    Calls the tagesschau api and grabs the latest news for given ressort
+    Calls the tagesschau api for the latest news of the ressort and updates the feed
+    Sends the validators of the last response, so unchanged news are not downloaded again (304)
 
     Parameters:
         ressort: ressort of the news
 
-    Returns:
-        response JSON from the tagesschau api
+    Raises:
+        APIError if the news could not be refreshed (the feed is marked as stale)
     """
+    feed = _feeds[ressort]
     # 4 is the region - defaulting to brandenburg
     url = f'https://www.tagesschau.de/api2u/news/?regions=4&ressort={ressort.value}'
-    headers = {"accept": "application/json"}  # pylint: disable=duplicate-code
-    response = requests.get(url, headers=headers, timeout=4)
-    response_json = response.json()
-
-    if response.status_code == 200:
-        return response_json
+    try:
+        status, reason, response_json, etag, last_modified = await get_json_if_changed(
+            url, feed.etag, feed.last_modified)
+        if status not in (200, 304):
+            error = response_json.get("error") if isinstance(response_json, dict) else None
+            raise APIError(error or reason, status)
+        if status == 200:
+            try:
+                news = [_create_news_object(n) for n in response_json["news"]]
+            except (KeyError, TypeError) as e:
+                raise APIError(f"unexpected response {e!r}", status) from e
+    except APIError:
+        feed.stale = True
+        raise
+
+    if status == 200:
+        feed.news = news
+        feed.etag = etag
+        feed.last_modified = last_modified
+    feed.refreshed_at = datetime.now()
+    feed.stale = False
+
+
+async def refresh_news():
+    """
+    Refreshes the news of all ressorts concurrently
 
-    raise APIError(response_json["error"], response.status_code)
+    Returns:
+        array of APIErrors of the ressorts which could not be refreshed
+    """
+    results = await asyncio.gather(
+        *(_refresh_feed(ressort) for ressort in Ressort), return_exceptions=True)
+    return [result for result in results if isinstance(result, Exception)]
 
 
-def parse_news_data_by_ressort(ressort: Ressort):
+def get_feed(ressort: Ressort):
     """
-    Parses the response json from the tagesschau api and puts it in the news class
+    Returns the feed of the ressort as it is in memory, without calling the api
 
     Parameters:
         ressort: ressort of the news
 
     Returns:
-        array - array containing news objects with the latest news for the given ressort
+        NewsFeed - refreshed_at is None if the ressort was never refreshed
     """
+    return _feeds[ressort]
 
-    def create_news_object(news_data):
-        title = news_data["title"]
-        teaser_image_url = news_data["teaserImage"]["imageVariants"]["1x1-144"]
-        details_web = news_data["detailsweb"]
-        breaking_news = news_data["breakingNews"]
-        return News(
-            title=title,
-            teaser_image_url=teaser_image_url,
-            details_web=details_web,
-            breaking_news=breaking_news)
 
-    try:
-        data = get_news(ressort)
-    except APIError as e:
-        return e
+async def get_latest_news(ressort: Ressort):
+    """
+    Returns the news of the ressort from memory, only calls the api
+    if the ressort was never refreshed (right after startup)
+
+    Parameters:
+        ressort: ressort of the news
+
+    Returns:
+        NewsFeed - news are ordered newest first, stale is set if the last refresh failed
+        or APIError if there are no news at all
+    """
+    feed = _feeds[ressort]
+    if feed.refreshed_at is None:
+        try:
+            await _refresh_feed(ressort)
+        except APIError as e:
+            return e
+    return feed
 
-    news = data["news"][:3]  # we only want the newest news
-    parsed_news = []
-    for n in news:
-        parsed_news.append(create_news_object(n))
 
-    return parsed_news
+def _latest_broadcast(now: datetime):
+    """
+    Returns the start of the latest tagesschau broadcast (20:00 in Berlin) before now
+    """
+    broadcast = datetime.combine(now.astimezone(TIMEZONE).date(), BROADCAST_TIME, TIMEZONE)
+    if broadcast > now:
+        broadcast = datetime.combine(broadcast.date() - timedelta(days=1), BROADCAST_TIME, TIMEZONE)
+    return broadcast
 
 
-def get_tagesschau_video_url():
+async def _fetch_tagesschau_video():
+    """
+    Calls the tagesschau api and picks the stream of the newest 20:00 broadcast
+    The url is cached until the next broadcast, if the api does not have the latest
+    broadcast yet it is asked again after VIDEO_RETRY_SECONDS
     """
-    Parses the response json from the tagesschau api and retrieves the video url
+    global _video  # pylint: disable=global-statement
+    data = await get_latest_tagesschau_channels()
+
+    broadcasts = []
+    for channel in data.get("channels", []):
+        try:
+            date = datetime.fromisoformat(channel["date"]).astimezone(TIMEZONE)
+            url = channel["streams"]["h264xl"]
+        except (KeyError, TypeError, ValueError):
+            continue
+        if channel.get("title") == "tagesschau" and date.time() == BROADCAST_TIME:
+            broadcasts.append((date, url))
+    if not broadcasts:
+        raise APIError("no tagesschau broadcast found", None)
+    date, url = max(broadcasts)
+
+    now = datetime.now(TIMEZONE)
+    latest_broadcast = _latest_broadcast(now)
+    if date >= latest_broadcast:
+        next_broadcast = datetime.combine(
+            latest_broadcast.date() + timedelta(days=1), BROADCAST_TIME, TIMEZONE)
+        expires_at = next_broadcast.timestamp()
+    else:
+        expires_at = now.timestamp() + VIDEO_RETRY_SECONDS
+    _video = (url, expires_at)
+    return url
+
+
+async def refresh_tagesschau_video():
+    """
+    Resolves the url of the latest tagesschau video and caches it (called after every broadcast)
 
     Returns:
-        str - video url of the latest tagesschau
+        str - video url of the latest tagesschau or APIError
     """
-    try:
-        data = get_latest_tagesschau_channels()
-    except APIError as e:
-        return e
+    async with _video_lock:
+        try:
+            return await _fetch_tagesschau_video()
+        except APIError as e:
+            return e
 
-    channels = data["channels"]
-    tagesschau = [channel for channel in channels
-                  if channel["title"] == "tagesschau"
-                  and "T20:00:00.000+01:00" in channel["date"]][0]
 
-    return tagesschau["streams"]["h264xl"]
+async def get_tagesschau_video_url():
+    """
+    Returns the video url of the latest tagesschau from the cache,
+    only calls the api if the cached url is from an older broadcast
+
+    Returns:
+        str - video url of the latest tagesschau or APIError
+    """
+    async with _video_lock:
+        if _video is not None and _video[1] > datetime.now().timestamp():
+            return _video[0]
+        try:
+            return await _fetch_tagesschau_video()
+        except APIError as e:
+            return e
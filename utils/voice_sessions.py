@@ -0,0 +1,267 @@
+""" voice sessions of the guilds - each one with its own voice client and queue of tracks """
+
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass
+import discord
+from utils.audio_cache import (
+    video_id_from_url, get_cached_audio, audio_file_source, pin, unpin)
+from utils.exceptions import DownloadFailedError, DownloadQueueFullError
+from utils.y2ubedownloader import (
+    DownloadJob, start_download, get_download_progress, cancel_download, resolve_stream)
+
+# a download taking longer than this shows its progress
+DOWNLOAD_PROGRESS_SECONDS = 2
+
+logger = logging.getLogger("discord")
+
+_sessions = {}  # guild id -> VoiceSession
+
+
+@dataclass
+class Track:
+    """
+    Class containing a requested track
+    """
+    url: str
+    channel: discord.abc.Messageable  # text channel the track was requested in
+    video_id: str = None
+    download: DownloadJob = None  # download into the cache, started while the track waits
+
+
+async def _wait_for_download(channel, job: DownloadJob):
+    """
+    Waits for the download and shows its progress in the channel if it takes a while
+
+    Returns:
+        id and title of the youtube video and the path of the audio file
+    """
+    message = None
+    while True:
+        done, _ = await asyncio.wait({job.future}, timeout=DOWNLOAD_PROGRESS_SECONDS)
+        if done:
+            break
+        text = f"Download: {await get_download_progress(job):.0%}"
+        if message is None:
+            message = await channel.send(text)
+        else:
+            await message.edit(content=text)
+    if message is not None:
+        await message.delete()
+    return job.future.result()
+
+
+class VoiceSession:  # pylint: disable=too-many-instance-attributes
+    """
+    Class containing the voice client of one guild, the playing track and the queue of next tracks
+    The next track is downloaded into the cache while the current one plays
+    """
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.voice_client = None
+        self.queue = deque()
+        self.current = None  # playing track
+        self._pinned = None  # video id of the played cached file
+        self._preparing = None  # task preparing the next track
+        self._waiting_for = None  # download the session waits for before it can play
+        self._stops = 0  # number of stops, a track prepared before a stop is not played
+        self._connecting = asyncio.Lock()  # one connect at a time, a second one would fail
+
+    async def connect(self, voice_channel):
+        """
+        Connects to the voice channel or moves there if the session is connected elsewhere
+        """
+        async with self._connecting:
+            if self.voice_client is None or not self.voice_client.is_connected():
+                self.voice_client = await voice_channel.connect()
+            elif self.voice_client.channel != voice_channel:
+                await self.voice_client.move_to(voice_channel)
+
+    async def add(self, url, voice_channel, channel):
+        """
+        Queues the track and starts playing if nothing is playing
+
+        Parameters:
+            url: url of the video that should be played
+            voice_channel: voice channel of the user
+            channel: text channel the track was requested in
+
+        Returns:
+            int - position in the queue, 0 if the track is played right away
+        """
+        await self.connect(voice_channel)
+        self.queue.append(Track(url=url, channel=channel, video_id=video_id_from_url(url)))
+        if self.current is None and (self._preparing is None or self._preparing.done()):
+            self._preparing = asyncio.get_running_loop().create_task(self._play_next())
+            return 0
+        self._prefetch_next()
+        return len(self.queue)
+
+    def stop(self):
+        """
+        Stops the playing track and forgets the queue
+        """
+        for track in self.queue:
+            if track.download is not None:
+                cancel_download(track.download)
+        self.queue.clear()
+        if self._waiting_for is not None:
+            cancel_download(self._waiting_for)
+            self._waiting_for = None
+        self._stops += 1
+        if self.voice_client is not None:
+            self.voice_client.stop()
+
+    def _prefetch_next(self):
+        """
+        Starts downloading the next track into the cache, so it plays without a gap
+        """
+        if not self.queue or self.queue[0].download is not None:
+            return
+        track = self.queue[0]
+        if track.video_id and get_cached_audio(track.video_id):
+            return
+        try:
+            track.download = start_download(track.url)
+        except DownloadQueueFullError:
+            pass  # the track is streamed instead
+
+    async def _play_next(self):
+        """
+        Prepares the next track of the queue and plays it (tracks which fail are skipped)
+        """
+        while self.queue:
+            track = self.queue.popleft()
+            stops = self._stops
+            source, video_id = await self._prepare(track)
+            if source is None:
+                continue
+            if stops != self._stops:  # stopped meanwhile, play what was queued after the stop
+                source.cleanup()
+                continue
+            if self.voice_client is None or not self.voice_client.is_connected():
+                source.cleanup()
+                return
+
+            self.current = track
+            # a cached file must not be evicted while it is played
+            if video_id is not None:
+                pin(video_id)
+                self._pinned = video_id
+            loop = asyncio.get_running_loop()
+            self.voice_client.play(
+                source, after=lambda error: loop.call_soon_threadsafe(self._finished, error))
+            self._prefetch_next()
+            return
+
+    def _finished(self, error):
+        """
+        Called when a track ended (runs in the event loop), plays the next one
+        """
+        if error is not None:
+            logger.error("Guild: %s - Voice session - Error: %s",
+                         self.guild_id, error)
+        if self._pinned is not None:
+            unpin(self._pinned)
+            self._pinned = None
+        self.current = None
+        self._preparing = asyncio.get_running_loop().create_task(self._play_next())
+
+    async def _prepare(self, track: Track):
+        """
+        Returns a source for the track - the cached file if it was downloaded already,
+        otherwise the stream (downloading into the cache meanwhile),
+        downloading first only if it can not be streamed
+
+        Returns:
+            audio source or None if the track can not be played (the user is told why),
+            video id of the cached file which is played or None if it is streamed
+        """
+        cached_path = get_cached_audio(track.video_id) if track.video_id else None
+        if cached_path is not None:  # no yt_dlp at all
+            return audio_file_source(cached_path), track.video_id
+        download = track.download
+        if download is not None and download.future.done() and not download.future.exception():
+            video_id, _, path = download.future.result()
+            return audio_file_source(path), video_id
+
+        try:
+            stream = await resolve_stream(track.url)
+        except DownloadFailedError as e:
+            logger.info("Guild: %s - INFO: streaming failed, downloading instead: %s",
+                        self.guild_id, e.message)
+            return await self._download(track)
+
+        if download is None:
+            try:
+                track.download = start_download(track.url)
+            except DownloadQueueFullError:
+                pass  # only the cache misses out
+        # opus streams are passed through, others are encoded by ffmpeg instead of discord.py
+        return discord.FFmpegOpusAudio(
+            stream.url, codec=stream.codec, before_options=stream.ffmpeg_before_options(),
+            options="-vn"), None
+
+    async def _download(self, track: Track):
+        """
+        Downloads the track into the cache (fallback if it can not be streamed)
+
+        Returns:
+            audio source or None if the download failed (the user is told why),
+            video id of the downloaded file
+        """
+        # download audio in a worker process, the bot stays responsive meanwhile
+        job = track.download
+        if job is None or job.future.done():
+            try:
+                job = start_download(track.url)
+            except DownloadQueueFullError as e:
+                logger.error("Guild: %s - Error: %s",
+                             self.guild_id, e.message)
+                await track.channel.send(
+                    "Gerade laufen zu viele Downloads, versuch es gleich nochmal!")
+                return None, None
+        self._waiting_for = job
+        try:
+            video_id, _, path = await _wait_for_download(track.channel, job)
+        except DownloadFailedError as e:
+            if job.cancelled:  # stopped by the user
+                return None, None
+            logger.error("Guild: %s - Error: %s",
+                         self.guild_id, e.message)
+            await track.channel.send(f"Etwas ist schiefgelaufen, ist die URL korrekt? {track.url}")
+            return None, None
+        finally:
+            if self._waiting_for is job:
+                self._waiting_for = None
+        return audio_file_source(path), video_id
+
+
+def get_voice_session(guild_id):
+    """
+    Returns the voice session of the guild, it is created on first use
+
+    Parameters:
+        guild_id: id of the guild
+
+    Returns:
+        VoiceSession
+    """
+    session = _sessions.get(guild_id)
+    if session is None:
+        session = _sessions[guild_id] = VoiceSession(guild_id)
+    return session
+
+
+def stop_voice_session(guild_id):
+    """
+    Stops playback and clears the queue of the guild, other guilds keep playing
+
+    Parameters:
+        guild_id: id of the guild
+    """
+    session = _sessions.get(guild_id)
+    if session is not None:
+        session.stop()
@@ -4,14 +4,17 @@ import os
 from datetime import datetime
 from dataclasses import dataclass
 import urllib.parse
-import requests
 from dotenv import load_dotenv
 from utils.exceptions import APIError
+from utils.helper import get_json, single_flight
 
 load_dotenv()
 
 API_KEY = os.environ.get("TOMMOROW_WEATHER_API_KEY")
 
+_forecasts = {}  # normalized location -> (expires at, response json)
+_pending_fetches = {}  # normalized location -> running fetch
+
 
 @dataclass
 class Weather():
@@ -47,30 +50,55 @@ class WeatherTomorrow:
     sunset_time: datetime = None
 
 
-def grab_forecast_by_city(location):
+def _normalize_location(location):
+    """
+    Normalizes a location string so different spellings share one cache entry
+    (e.g. "  berlin" and "Berlin")
     """
-    Calls the Weather API (api.tomorrow.io) and grabs a weather forecast
+    return " ".join(location.casefold().split())
 
-    Parameters:
-        location - location string defining for where the api should get the weather for
 
-    Returns:
-        response JSON from the weather api
+async def _fetch_forecast(location, key):
+    """
+    Calls the Weather API (api.tomorrow.io), grabs a weather forecast and caches it
+    until the next full hour (the forecast has an hourly granularity)
     """
     encoded_city = urllib.parse.quote(location)
     url = f"https://api.tomorrow.io/v4/weather/forecast?location={encoded_city}&apikey={API_KEY}"
 
     headers = {"accept": "application/json"}
-    response = requests.get(url, headers=headers, timeout=4)
-    response_json = response.json()
+    status, _, response_json = await get_json(url, headers=headers)
+
+    if status != 200:
+        raise APIError(response_json["message"], status)
+
+    now = datetime.now().timestamp()
+    for cached_key in [k for k, (expires, _) in _forecasts.items() if expires <= now]:
+        del _forecasts[cached_key]
+    _forecasts[key] = ((now // 3600 + 1) * 3600, response_json)
+    return response_json
 
-    if response.status_code == 200:
-        return response_json
 
-    raise APIError(response_json["message"], response.status_code)
+async def grab_forecast_by_city(location):
+    """
+    Returns the weather forecast for the location, cached until the next full hour
+    Concurrent calls for the same location share one request to the api
+
+    Parameters:
+        location - location string defining for where the api should get the weather for
+
+    Returns:
+        response JSON from the weather api
+    """
+    key = _normalize_location(location)
+    cached = _forecasts.get(key)
+    if cached is not None and cached[0] > datetime.now().timestamp():
+        return cached[1]
+
+    return await single_flight(_pending_fetches, key, lambda: _fetch_forecast(location, key))
 
 
-def parse_weather_data_by_location_today(location_input):
+async def parse_weather_data_by_location_today(location_input):
     """
     Parses the response json from the weather api and puts it in the weather class
 
@@ -81,7 +109,7 @@ def parse_weather_data_by_location_today(location_input):
         array - array containing 4 weather objects with the forecast for the next 6 hours
     """
     try:
-        data = grab_forecast_by_city(location_input)
+        data = await grab_forecast_by_city(location_input)
     except APIError as e:
         return e
 
@@ -115,7 +143,7 @@ def parse_weather_data_by_location_today(location_input):
     return [next_hour, two_hours, fours_hours, six_hours]
 
 
-def parse_weather_data_by_location_tomorrow(location_input):
+async def parse_weather_data_by_location_tomorrow(location_input):
     """
     Parses the response json from the weather api and puts it in the weather class
 
@@ -126,7 +154,7 @@ def parse_weather_data_by_location_tomorrow(location_input):
         weather - weather object containing weather forecast for the upcoming day
     """
     try:
-        data = grab_forecast_by_city(location_input)
+        data = await grab_forecast_by_city(location_input)
     except APIError as e:
         return e
 
@@ -0,0 +1,70 @@
+""" in-memory store of the weather icons and the urls of their uploaded copies """
+
+import os
+import time
+import urllib.parse
+
+# discord signs attachment urls with an expiry (ex) - renew them a bit earlier
+EXPIRY_MARGIN_SECONDS = 60 * 60
+# used if an url has no expiry parameter
+DEFAULT_URL_LIFETIME_SECONDS = 12 * 60 * 60
+
+_icons = {}  # weather code -> png bytes
+_uploaded_urls = {}  # weather code -> (url, expires at)
+
+
+def load_icons():
+    """
+    Reads all weather icons into memory (called once on startup)
+    """
+    icon_dir = f"{os.getcwd()}/utils/weather_icons"
+    for filename in os.listdir(icon_dir):
+        code, extension = os.path.splitext(filename)
+        if extension == ".png":
+            with open(f"{icon_dir}/{filename}", "rb") as f:
+                _icons[int(code)] = f.read()
+
+
+def get_icon(weather_code):
+    """
+    Returns the icon for the weather code
+
+    Parameters:
+        weather_code: weather code of the tomorrow.io api
+
+    Returns:
+        bytes of the png or None if there is no icon for the code
+    """
+    return _icons.get(int(weather_code))
+
+
+def get_uploaded_url(weather_code):
+    """
+    Returns the url of an already uploaded copy of the icon if it is still valid
+
+    Parameters:
+        weather_code: weather code of the tomorrow.io api
+
+    Returns:
+        url or None if the icon has to be uploaded (again)
+    """
+    uploaded = _uploaded_urls.get(int(weather_code))
+    if uploaded is None or uploaded[1] - EXPIRY_MARGIN_SECONDS <= time.time():
+        return None
+    return uploaded[0]
+
+
+def remember_uploaded_url(weather_code, url):
+    """
+    Remembers the url discord gave the uploaded icon, so it can be reused instead of uploading again
+
+    Parameters:
+        weather_code: weather code of the tomorrow.io api
+        url: url of the uploaded icon
+    """
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+    try:
+        expires_at = int(query["ex"][0], 16)
+    except (KeyError, ValueError):
+        expires_at = time.time() + DEFAULT_URL_LIFETIME_SECONDS
+    _uploaded_urls[int(weather_code)] = (url, expires_at)
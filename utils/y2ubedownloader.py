@@ -1,43 +1,268 @@
 """ utility for downloading video/audio from youtube """
 
+import asyncio
+import itertools
+import multiprocessing
 import os
+import shlex
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 import yt_dlp
 from dotenv import load_dotenv
-from utils.exceptions import DownloadFailedError
+from utils.audio_cache import AUDIO_DIR, add_to_cache, video_id_from_url, pin, unpin
+from utils.exceptions import DownloadFailedError, DownloadQueueFullError
 
 load_dotenv()
 
 YOUTUBE_COOKIEFILE = os.environ.get("YOUTUBE_COOKIEFILE")
 
+# downloads run in worker processes, so yt_dlp and ffmpeg never block the event loop
+MAX_PARALLEL_DOWNLOADS = 2
+# downloads which are running or waiting for a worker, further requests are rejected
+MAX_QUEUED_DOWNLOADS = 8
+# streams are resolved in their own workers, so playback never waits behind a download
+MAX_PARALLEL_RESOLVES = 2
 
-async def download_audio(url):
+_context = multiprocessing.get_context("spawn")  # forking a process with threads is unsafe
+_executor = None  # pylint: disable=invalid-name
+_stream_executor = None  # pylint: disable=invalid-name
+_manager = None  # pylint: disable=invalid-name
+# dicts shared with the workers: job id -> downloaded fraction / job id -> True if cancelled
+_progress = None  # pylint: disable=invalid-name
+_cancelled = None  # pylint: disable=invalid-name
+_jobs = {}  # url -> running DownloadJob
+# opus is preferred everywhere, so discord gets the audio without re-encoding it (codec copy)
+AUDIO_FORMAT = 'bestaudio[acodec=opus]/bestaudio/best'
+# ffmpeg reconnects if the connection to a stream drops instead of ending the track
+FFMPEG_RECONNECT_OPTIONS = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+_job_ids = itertools.count()
+
+
+@dataclass
+class DownloadJob:
     """
-    Utilizes yt_dlp to download audio from given url
+    Class containing a running download, shared by everyone who asked for the same url
+    """
+    id: int
+    url: str
+    future: asyncio.Future  # resolves to [id, title, path] of the video
+    users: int = 1
+    cancelled: bool = False
 
-    Parameters:
-        url - url of the youtube video that should be downloaded
+
+@dataclass
+class AudioStream:
+    """
+    Class containing the direct url of the audio stream of a video
+    """
+    id: str
+    title: str
+    url: str
+    http_headers: dict
+    codec: str = None  # audio codec of the stream, e.g. opus
+
+    def ffmpeg_before_options(self):
+        """
+        Returns the ffmpeg input options to play the stream (reconnect and the headers yt_dlp uses)
+        """
+        options = FFMPEG_RECONNECT_OPTIONS
+        if self.http_headers:
+            headers = "".join(f"{key}: {value}\r\n" for key, value in self.http_headers.items())
+            options += f" -headers {shlex.quote(headers)}"
+        return options
+
+
+def _resolve_stream(url):
+    """
+    Utilizes yt_dlp to find the direct url of the best audio stream (runs in a worker process)
+
+    Returns:
+        AudioStream
+    """
+    ydl_opts = {
+        'cookiefile': YOUTUBE_COOKIEFILE,
+        'format': AUDIO_FORMAT,
+        'noplaylist': True,
+        'quiet': True,
+    }
+
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            video_info = ydl.extract_info(url, download=False)
+    except Exception as e:
+        # yt_dlp errors can not always be pickled back to the bot process
+        raise DownloadFailedError(repr(e)) from None
+
+    if not video_info.get("url"):  # e.g. playlists or merged formats
+        raise DownloadFailedError(f"no single audio stream for {url}")
+    return AudioStream(id=video_info["id"], title=video_info.get("title"),
+                       url=video_info["url"], http_headers=video_info.get("http_headers") or {},
+                       codec=video_info.get("acodec"))
+
+
+def _download(url, job_id, progress, cancelled):
+    """
+    Utilizes yt_dlp to download audio from given url (runs in a worker process)
 
     Returns:
-        title and id of the youtube video
+        id and title of the youtube video and the path of the audio file
     """
+    def progress_hook(status):
+        if cancelled.get(job_id):
+            raise yt_dlp.utils.DownloadCancelled()
+        total = status.get("total_bytes") or status.get("total_bytes_estimate")
+        if status["status"] == "downloading" and total:
+            progress[job_id] = status.get("downloaded_bytes", 0) / total
+
     # options/config for download
     ydl_opts = {
         'cookiefile': YOUTUBE_COOKIEFILE,
-        'format': 'm4a/bestaudio/best',
-        'postprocessors': [{  # Extract audio using ffmpeg (needs to be installed)
+        'format': AUDIO_FORMAT,
+        # Extract audio using ffmpeg (needs to be installed) - stored as opus once,
+        # opus sources are only remuxed, everything else is transcoded here instead of on playback
+        'postprocessors': [{
             'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'm4a',
+            'preferredcodec': 'opus',
         }],
-        'paths': {'home': f'{os.getcwd()}/audio'},
-        'writethumbnail': 'true',  # also save thumbnail cause why not
-
+        # files are stored by video id, so the cache finds them again
+        'paths': {'home': AUDIO_DIR},
+        'outtmpl': '%(id)s.%(ext)s',
+        'progress_hooks': [progress_hook],
     }
 
     try:
+        if cancelled.get(job_id):  # cancelled while waiting for a worker
+            raise yt_dlp.utils.DownloadCancelled()
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
             # also downloads video/audio file
             video_info = ydl.extract_info(url)
     except Exception as e:
-        raise DownloadFailedError(e.args) from e
+        # yt_dlp errors can not always be pickled back to the bot process
+        raise DownloadFailedError(repr(e)) from None
+
+    downloads = video_info.get("requested_downloads") or [{}]
+    path = downloads[0].get("filepath", f"{AUDIO_DIR}/{video_info['id']}.opus")
+    return [video_info["id"], video_info["title"], path]
+
+
+def _start_workers():
+    global _executor, _manager, _progress, _cancelled  # pylint: disable=global-statement
+    if _executor is None:
+        _manager = _context.Manager()
+        _progress = _manager.dict()
+        _cancelled = _manager.dict()
+        _executor = ProcessPoolExecutor(max_workers=MAX_PARALLEL_DOWNLOADS, mp_context=_context)
+
+
+def _start_stream_workers():
+    global _stream_executor  # pylint: disable=global-statement
+    if _stream_executor is None:
+        _stream_executor = ProcessPoolExecutor(
+            max_workers=MAX_PARALLEL_RESOLVES, mp_context=_context)
+
+
+def start_download(url):
+    """
+    Starts downloading the audio of the url in a worker process into the audio cache
+    If the url is already downloading, the running download is shared
+
+    Parameters:
+        url - url of the youtube video that should be downloaded
+
+    Returns:
+        DownloadJob - await job.future for the [id, title, path] of the video
+
+    Raises:
+        DownloadQueueFullError if too many downloads are running or waiting
+    """
+    job = _jobs.get(url)
+    if job is not None and not job.cancelled:
+        job.users += 1
+        return job
+    if len(_jobs) >= MAX_QUEUED_DOWNLOADS:
+        raise DownloadQueueFullError(MAX_QUEUED_DOWNLOADS)
+
+    _start_workers()
+    job_id = next(_job_ids)
+    future = asyncio.get_running_loop().run_in_executor(
+        _executor, _download, url, job_id, _progress, _cancelled)
+    job = DownloadJob(id=job_id, url=url, future=future)
+    _jobs[url] = job
+    # the partial files of the download are no leftovers of the cache
+    video_id = video_id_from_url(url)
+    if video_id is not None:
+        pin(video_id)
+
+    def cleanup(_):
+        if _jobs.get(url) is job:
+            del _jobs[url]
+        if video_id is not None:
+            unpin(video_id)
+        _progress.pop(job_id, None)
+        _cancelled.pop(job_id, None)
+        # also marks the exception as retrieved for downloads nobody waits for
+        if not future.cancelled() and future.exception() is None:
+            downloaded_id, _, path = future.result()
+            add_to_cache(downloaded_id, path)
+    future.add_done_callback(cleanup)
+    return job
+
+
+async def resolve_stream(url):
+    """
+    Resolves the direct url of the audio stream in a worker process (not one of the download
+    workers), so playback can start without downloading the whole file first
+
+    Parameters:
+        url - url of the youtube video that should be played
+
+    Returns:
+        AudioStream
+
+    Raises:
+        DownloadFailedError if there is no stream which ffmpeg can play directly
+    """
+    _start_stream_workers()
+    return await asyncio.get_running_loop().run_in_executor(
+        _stream_executor, _resolve_stream, url)
+
+
+async def get_download_progress(job: DownloadJob):
+    """
+    Returns how much of the job is downloaded
+
+    Returns:
+        float between 0 and 1
+    """
+    if job.future.done():
+        return 1.0
+    # the shared dict lives in the manager process - do not block the event loop on it
+    return await asyncio.get_running_loop().run_in_executor(None, _progress.get, job.id, 0.0)
+
+
+def cancel_download(job: DownloadJob):
+    """
+    Gives up on a download, it is only stopped if nobody else is waiting for it
+    The worker stops at its next progress update and job.future fails with DownloadFailedError
+
+    Parameters:
+        job: the download
+    """
+    job.users -= 1
+    if job.users > 0 or job.future.done():
+        return
+    job.cancelled = True
+    _cancelled[job.id] = True
 
-    return [video_info["id"], video_info["title"]]
+
+async def download_audio(url):
+    """
+    Downloads audio from given url without blocking the bot
+
+    Parameters:
+        url - url of the youtube video that should be downloaded
+
+    Returns:
+        id and title of the youtube video and the path of the audio file
+    """
+    return await start_download(url).future